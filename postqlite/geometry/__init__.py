@@ -4,6 +4,17 @@ from . import dump
 from . import fileformats
 from . import serialize
 from . import geometry
+from . import wkb
+from . import blob
+from . import cache
+from . import index
+from . import keys
+from . import nearest
+from . import join
+
+from .index import create_spatial_index, drop_spatial_index, cluster_table
+from .nearest import knn
+from .join import spatial_join
 
 
 
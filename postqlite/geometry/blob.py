@@ -0,0 +1,70 @@
+
+# optional geom blob format that stores the srid and envelope ahead of the wkb,
+# using the geopackage binary header so the blobs can also be read by other software
+# see: http://www.geopackage.org/spec/#gpb_format
+#
+# +------------+---------+---------------------------------------------+
+# | magic      | 2 bytes | 'GP'                                        |
+# | version    | uint8   | 0                                           |
+# | flags      | uint8   | bit 0: byteorder, bits 1-3: envelope type,  |
+# |            |         | bit 4: empty geometry                       |
+# | srs_id     | int32   |                                             |
+# | envelope   | 0 or 4  | minx, maxx, miny, maxy                      |
+# |            | doubles |                                             |
+# | wkb        |         |                                             |
+# +------------+---------+---------------------------------------------+
+
+from struct import Struct, unpack_from
+import math
+
+from .index import _quote
+
+
+GPB_MAGIC = b'GP'
+
+_HEADER = Struct('<2sBBi')
+_ENVELOPE = Struct('<dddd')
+_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+
+def is_gpb(blob):
+    return blob[:2] == GPB_MAGIC
+
+def read_gpb_header(blob):
+    '''Returns the srid, the (xmin,ymin,xmax,ymax) envelope or None, and the offset of the wkb'''
+    (flags,) = unpack_from('B', blob, 3)
+    byteorder = '<' if flags & 1 else '>'
+    (srid,) = unpack_from(byteorder+'i', blob, 4)
+    envtype = (flags >> 1) & 7
+    offset = 8
+    if envtype:
+        # only the xy part is needed, any z/m ranges follow after it
+        xmin,xmax,ymin,ymax = unpack_from(byteorder+'dddd', blob, offset)
+        bbox = xmin,ymin,xmax,ymax
+    else:
+        bbox = None
+    offset += _ENVELOPE_SIZES[envtype]
+    return srid, bbox, offset
+
+def write_gpb(wkb, bbox, srid=0):
+    '''Prepends a geopackage header with the given envelope to a wkb blob'''
+    xmin,ymin,xmax,ymax = bbox
+    if any(math.isnan(v) for v in bbox):
+        # empty geometry, no envelope
+        flags = 1 | (1 << 4)
+        return _HEADER.pack(GPB_MAGIC, 0, flags, srid) + bytes(wkb)
+    else:
+        flags = 1 | (1 << 1)
+        return _HEADER.pack(GPB_MAGIC, 0, flags, srid) + _ENVELOPE.pack(xmin,xmax,ymin,ymax) + bytes(wkb)
+
+
+def convert_column(conn, table, column, embed_bbox=True):
+    '''Rewrites all values of a geom column, either to the embedded bbox format (embed_bbox=True)
+    or back to plain wkb (embed_bbox=False). Reading is transparent either way.'''
+    func = 'st_AsGPB' if embed_bbox else 'st_AsBinary'
+    sql = 'update {table} set {col} = {func}({col}) where {col} is not null'.format(table=_quote(table),
+                                                                                  col=_quote(column),
+                                                                                  func=func)
+    conn.execute(sql)
+    conn.commit()
+
@@ -0,0 +1,85 @@
+
+from collections import OrderedDict
+import hashlib
+
+from shapely.wkb import loads as wkb_loads
+from shapely.prepared import prep
+
+
+class GeometryCache(object):
+    '''Bounded LRU cache of shapely geometries, keyed by a digest of their wkb bytes.
+    Each reference to a geom column in a query creates a new Geometry instance,
+    so without this the same blob gets converted to shapely over and over.
+    The size of each entry is approximated by the length of its wkb.
+    '''
+    def __init__(self, maxbytes=64*1024*1024):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def load(self, wkb):
+        '''wkb buffer to shapely, reusing a previously loaded geometry if possible'''
+        key = hashlib.sha1(wkb).digest()
+        item = self._items.pop(key, None)
+        if item is not None:
+            # reinsert as most recently used
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+        self.misses += 1
+        shp = wkb_loads(wkb.tobytes())
+        size = len(wkb)
+        if size <= self.maxbytes:
+            self._items[key] = (shp, size)
+            self.nbytes += size
+            # evict least recently used
+            while self.nbytes > self.maxbytes:
+                _,(_,oldsize) = self._items.popitem(last=False)
+                self.nbytes -= oldsize
+        return shp
+
+    def clear(self):
+        self._items.clear()
+        self.nbytes = 0
+
+    def info(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'items': len(self._items),
+                'bytes': self.nbytes,
+                'maxbytes': self.maxbytes}
+
+
+class PreparedArg(object):
+    '''Keeps a prepared version of a function argument once the same blob is passed in
+    twice in a row, ie when the argument is a constant in the query.
+    Meant to be used for one argument position of one function.
+    '''
+    def __init__(self):
+        self._last = None
+        self._prepared = None
+        self.bbox = None
+
+    def get(self, wkb, geom):
+        '''Returns the prepared version of geom if wkb is repeated, otherwise None.
+        The bbox of the prepared geom is kept in .bbox, so it is only read once too.'''
+        if self._last is not None and wkb == self._last:
+            if self._prepared is None:
+                self.bbox = geom.bbox()
+                if geom._shp is None:
+                    geom._load_shapely()
+                self._prepared = prep(geom._shp)
+            return self._prepared
+        else:
+            # new value, forget the previous one
+            self._last = wkb
+            self._prepared = None
+            self.bbox = None
+            return None
+
@@ -3,115 +3,166 @@ from sqlite3 import Binary
 
 from shapely.wkb import loads as wkb_loads
 from shapely.wkt import loads as wkt_loads
-from shapely.geometry import asShape, Point, MultiPoint, Polygon, box
+from shapely.geometry import asShape
 from shapely.ops import unary_union
 
-from struct import unpack, unpack_from
-from io import BytesIO
-from itertools import islice
+from struct import unpack_from, pack
+from multiprocessing import Pool, cpu_count
 import json
 import math
 import sys
+import atexit
+
+from .cache import GeometryCache, PreparedArg
+from .wkb import write_point, write_polygon, write_envelope, write_box2d, read_header, read_bbox, read_geometry, wkbtype_to_shptype
+from .wkb_text import write_wkt, write_geojson, geojson_dict
+from . import measure
+from .keys import bbox_key, bbox_geohash, bbox_quadkey
+from .blob import is_gpb, read_gpb_header, write_gpb
 
 
 PY2 = sys.version_info[0] == 2
 
 
-def _wkb_byteorder(wkb):
-    byteorder = unpack_from('b', wkb)[0]
-    byteorder = '>' if byteorder == 0 else '<'
-    return byteorder
+def _bbox_intersects(bbox, otherbbox):
+    xmin,ymin,xmax,ymax = bbox
+    oxmin,oymin,oxmax,oymax = otherbbox
+    return xmin <= oxmax and xmax >= oxmin and ymin <= oymax and ymax >= oymin
 
+def _expand_bbox(bbox, units):
+    xmin,ymin,xmax,ymax = bbox
+    return xmin-units, ymin-units, xmax+units, ymax+units
 
-wkbtype_to_shptype = {1: 'Point',
-                      2: 'LineString',
-                      3: 'Polygon',
-                      4: 'MultiPoint',
-                      5: 'MultiLineString',
-                      6: 'MultiPolygon',
-                      7: 'GeometryCollection'}
+def _bbox_distance(bbox, otherbbox):
+    # shortest distance between two bboxes, 0 if they overlap
+    # always <= the real distance between the geometries, so can be used as a lower bound
+    xmin,ymin,xmax,ymax = bbox
+    oxmin,oymin,oxmax,oymax = otherbbox
+    dx = max(oxmin - xmax, xmin - oxmax, 0)
+    dy = max(oymin - ymax, ymin - oymax, 0)
+    return math.hypot(dx, dy)
 
 
-def register_funcs(conn):
+def register_funcs(conn, cache=None):
     # see: https://postgis.net/docs/reference.html
 
+    # shapely geometries are cached per connection, so that the same blob referenced
+    # several times in a query is only converted once
+    if cache is None:
+        cache = GeometryCache()
+    def _geom(wkb):
+        return Geometry(wkb, cache=cache)
+
     # constructors
-    # TODO: maybe make more effective by converting directly, without the shapely overhead
-    conn.create_function('st_Point', 2, lambda x,y: Geometry(shp=Point(x,y)).dump_wkb() )
-    conn.create_function('st_MakeEnvelope', 4, lambda xmin,ymin,xmax,ymax: Geometry(shp=box(xmin,ymin,xmax,ymax)).dump_wkb() )
+    conn.create_function('st_Point', 2, lambda x,y: Geometry(write_point(x,y)).dump_wkb() )
+    conn.create_function('st_MakeEnvelope', 4, lambda xmin,ymin,xmax,ymax: Geometry(write_envelope(xmin,ymin,xmax,ymax)).dump_wkb() )
     conn.create_function('st_GeomFromText', 1, lambda wkt: Geometry(shp=wkt_loads(wkt)).dump_wkb() )
     conn.create_function('st_GeomFromGeoJSON', 1, lambda geojstr: Geometry(shp=asShape(json.loads(geojstr))).dump_wkb() )
 
     # representation
-    conn.create_function('st_AsText', 1, lambda wkb: Geometry(wkb).as_WKT() if wkb != None else None )
-    conn.create_function('st_AsGeoJSON', 1, lambda wkb: json.dumps(Geometry(wkb).as_GeoJSON()) if wkb != None else None )
-    conn.create_function('st_AsRaster', -1, lambda *args: Geometry(args[0]).as_raster(*args[1:]).dump_wkb() if args[0] else None )
+    conn.create_function('st_AsText', -1, lambda wkb,precision=None: _geom(wkb).as_WKT(precision) if wkb != None else None )
+    conn.create_function('st_AsGeoJSON', -1, lambda wkb,precision=None: _geom(wkb).dump_geojson(precision) if wkb != None else None )
+    conn.create_function('st_AsBinary', 1, lambda wkb: _geom(wkb).dump_wkb(plain=True) if wkb != None else None )
+    conn.create_function('st_AsGPB', -1, lambda *args: _geom(args[0]).dump_gpb(*args[1:]) if args[0] != None else None )
+    conn.create_function('st_AsRaster', -1, lambda *args: _geom(args[0]).as_raster(*args[1:]).dump_wkb() if args[0] else None )
     
     # brings back simple types
-    conn.create_function('GeometryType', 1, lambda wkb: Geometry(wkb).type() if wkb != None else None )
-    conn.create_function('st_Area', 1, lambda wkb: Geometry(wkb).area() if wkb != None else None )
-    conn.create_function('st_Xmin', 1, lambda wkb: Geometry(wkb).bbox()[0] if wkb != None else None )
-    conn.create_function('st_Xmax', 1, lambda wkb: Geometry(wkb).bbox()[2] if wkb != None else None )
-    conn.create_function('st_Ymin', 1, lambda wkb: Geometry(wkb).bbox()[1] if wkb != None else None )
-    conn.create_function('st_Ymax', 1, lambda wkb: Geometry(wkb).bbox()[3] if wkb != None else None )
+    conn.create_function('GeometryType', 1, lambda wkb: _geom(wkb).type() if wkb != None else None )
+    conn.create_function('st_SRID', 1, lambda wkb: _geom(wkb).srid() if wkb != None else None )
+    conn.create_function('st_Area', 1, lambda wkb: _geom(wkb).area() if wkb != None else None )
+    conn.create_function('st_Length', 1, lambda wkb: _geom(wkb).length() if wkb != None else None )
+    conn.create_function('st_Perimeter', 1, lambda wkb: _geom(wkb).perimeter() if wkb != None else None )
+    conn.create_function('st_Xmin', 1, lambda wkb: _geom(wkb).bbox()[0] if wkb != None else None )
+    conn.create_function('st_Xmax', 1, lambda wkb: _geom(wkb).bbox()[2] if wkb != None else None )
+    conn.create_function('st_Ymin', 1, lambda wkb: _geom(wkb).bbox()[1] if wkb != None else None )
+    conn.create_function('st_Ymax', 1, lambda wkb: _geom(wkb).bbox()[3] if wkb != None else None )
+
+    # space filling curve keys of the bbox centre, within the bbox of an extent geom
+    def _curve_key(curve):
+        def func(wkb, extentwkb, bits=16):
+            if wkb is None or extentwkb is None:
+                return None
+            return bbox_key(_geom(wkb).bbox(), _geom(extentwkb).bbox(), bits, curve)
+        return func
+
+    conn.create_function('st_HilbertKey', -1, _curve_key('hilbert') )
+    conn.create_function('st_ZOrderKey', -1, _curve_key('zorder') )
+    conn.create_function('st_GeoHash', -1, lambda wkb,precision=12: bbox_geohash(_geom(wkb).bbox(), int(precision)) if wkb != None else None )
+    conn.create_function('st_QuadKey', 2, lambda wkb,zoom: bbox_quadkey(_geom(wkb).bbox(), int(zoom)) if wkb != None else None )
+
+    # predicates keep a prepared version of any argument that is constant across rows
+    def _predicate(name):
+        prepared1 = PreparedArg()
+        prepared2 = PreparedArg()
+        def func(wkb, otherwkb):
+            if wkb is None or otherwkb is None:
+                return None
+            geom,othergeom = _geom(wkb),_geom(otherwkb)
+            geom._set_prepared(prepared1.get(wkb, geom), prepared1.bbox)
+            othergeom._set_prepared(prepared2.get(otherwkb, othergeom), prepared2.bbox)
+            return getattr(geom, name)(othergeom)
+        return func
 
-    conn.create_function('st_Intersects', 2, lambda wkb,otherwkb: Geometry(wkb).intersects(Geometry(otherwkb)) if wkb != None and otherwkb != None else None )
-    conn.create_function('st_Disjoint', 2, lambda wkb,otherwkb: Geometry(wkb).disjoint(Geometry(otherwkb)) if wkb != None and otherwkb != None else None )
+    conn.create_function('st_Intersects', 2, _predicate('intersects') )
+    conn.create_function('st_Disjoint', 2, _predicate('disjoint') )
 
-    conn.create_function('st_Distance', 2, lambda wkb,otherwkb: Geometry(wkb).distance(Geometry(otherwkb)) if wkb != None else None )
+    conn.create_function('st_DWithin', 3, lambda wkb,otherwkb,dist: _geom(wkb).dwithin(_geom(otherwkb), dist) if wkb != None and otherwkb != None else None )
+    conn.create_function('st_Distance', 2, lambda wkb,otherwkb: _geom(wkb).distance(_geom(otherwkb)) if wkb != None else None )
 
     # brings back geom
-    conn.create_function('Box2d', 1, lambda wkb: Geometry(wkb).box2d().dump_wkb() if wkb != None else None )
-    conn.create_function('st_Envelope', 1, lambda wkb: Geometry(wkb).envelope().dump_wkb() if wkb != None else None )
-    conn.create_function('st_Expand', 2, lambda wkb,dist: Geometry(wkb).expand(dist).dump_wkb() if wkb != None else None )
+    conn.create_function('Box2d', 1, lambda wkb: _geom(wkb).box2d().dump_wkb() if wkb != None else None )
+    conn.create_function('st_Envelope', 1, lambda wkb: _geom(wkb).envelope().dump_wkb() if wkb != None else None )
+    conn.create_function('st_Expand', 2, lambda wkb,dist: _geom(wkb).expand(dist).dump_wkb() if wkb != None else None )
     
-    conn.create_function('st_Centroid', 1, lambda wkb: Geometry(wkb).centroid().dump_wkb() if wkb != None else None )
-    conn.create_function('st_Buffer', 2, lambda wkb,dist: Geometry(wkb).buffer(dist).dump_wkb() if wkb != None else None )
+    conn.create_function('st_Centroid', 1, lambda wkb: _geom(wkb).centroid().dump_wkb() if wkb != None else None )
+    conn.create_function('st_Buffer', 2, lambda wkb,dist: _geom(wkb).buffer(dist).dump_wkb() if wkb != None else None )
     
-    conn.create_function('st_Intersection', 2, lambda wkb,otherwkb: Geometry(wkb).intersection(Geometry(otherwkb)).dump_wkb() if wkb != None and otherwkb != None else None )
-    conn.create_function('st_Difference', 2, lambda wkb,otherwkb: Geometry(wkb).difference(Geometry(otherwkb)).dump_wkb() if wkb != None and otherwkb != None else None )
-    conn.create_function('st_Union', 2, lambda wkb,otherwkb: Geometry(wkb).union(Geometry(otherwkb)).dump_wkb() if wkb != None and otherwkb != None else None )
+    conn.create_function('st_Intersection', 2, lambda wkb,otherwkb: _geom(wkb).intersection(_geom(otherwkb)).dump_wkb() if wkb != None and otherwkb != None else None )
+    conn.create_function('st_Difference', 2, lambda wkb,otherwkb: _geom(wkb).difference(_geom(otherwkb)).dump_wkb() if wkb != None and otherwkb != None else None )
+    conn.create_function('st_Union', 2, lambda wkb,otherwkb: _geom(wkb).union(_geom(otherwkb)).dump_wkb() if wkb != None and otherwkb != None else None )
+
+    conn.create_function('st_Simplify', 2, lambda wkb,tol: _geom(wkb).simplify(tol, preserve_topology=False).dump_wkb() if wkb != None else None )
+    conn.create_function('st_SimplifyPreserveTopology', 2, lambda wkb,tol: _geom(wkb).simplify(tol, preserve_topology=True).dump_wkb() if wkb != None else None )
 
-    conn.create_function('st_Simplify', 2, lambda wkb,tol: Geometry(wkb).simplify(tol, preserve_topology=False).dump_wkb() if wkb != None else None )
-    conn.create_function('st_SimplifyPreserveTopology', 2, lambda wkb,tol: Geometry(wkb).simplify(tol, preserve_topology=True).dump_wkb() if wkb != None else None )
+    # cache management
+    conn.create_function('st_CacheInfo', 0, lambda: json.dumps(cache.info()) )
+    conn.create_function('st_ClearCache', 0, lambda: cache.clear() )
 
 def register_aggs(conn):
     conn.create_aggregate('st_Extent', 1, ST_Extent)
     conn.create_aggregate('st_Union', 1, ST_Union)
+    conn.create_aggregate('st_ParallelUnion', -1, ST_ParallelUnion)
     
 
 # aggs
 
 class ST_Extent(object):
+    # keeps a running min/max, bboxes come from the blob header if embedded,
+    # otherwise parsed from the wkb without shapely
+    # for an indexed column, see also index.spatial_index_extent()
     def __init__(self):
-        self.chunksize = 10000
-        self.boxes = []
-        self.result = None
+        self.xmin = self.ymin = float('inf')
+        self.xmax = self.ymax = float('-inf')
 
     def step(self, wkb):
         if wkb is None:
             return
-        self.boxes.append(Geometry(wkb).bbox())
-        if len(self.boxes) >= self.chunksize:
-            if self.result:
-                # include any previous result
-                self.boxes.append(self.result) 
-            xmins,ymins,xmaxs,ymaxs = zip(*self.boxes)
-            self.result = min(xmins),min(ymins),max(xmaxs),max(ymaxs)
-            self.boxes = []
+        xmin,ymin,xmax,ymax = Geometry(wkb).bbox()
+        # nan bboxes of empty geoms are ignored since all comparisons are false
+        if xmin < self.xmin:
+            self.xmin = xmin
+        if ymin < self.ymin:
+            self.ymin = ymin
+        if xmax > self.xmax:
+            self.xmax = xmax
+        if ymax > self.ymax:
+            self.ymax = ymax
 
     def finalize(self):
-        if self.boxes:
-            # any remaining boxes
-            if self.result:
-                # include any previous result
-                self.boxes.append(self.result) 
-            xmins,ymins,xmaxs,ymaxs = zip(*self.boxes)
-            self.result = min(xmins),min(ymins),max(xmaxs),max(ymaxs)
-            self.boxes = []
-        # return result
-        xmin,ymin,xmax,ymax = self.result
-        pointbox = Geometry(shp=MultiPoint([(xmin,ymin),(xmax,ymax)]))
+        if self.xmin > self.xmax:
+            # no rows, or only empty geoms
+            return None
+        pointbox = Geometry(write_box2d(self.xmin,self.ymin,self.xmax,self.ymax))
         return pointbox.dump_wkb()
 
 class ST_Union(object):
@@ -150,222 +201,277 @@ class ST_Union(object):
         resultgeom = Geometry(shp=self.result)
         return resultgeom.dump_wkb()
 
-# class
+# one process pool per number of workers, shared by all st_ParallelUnion aggregates,
+# and only created once there is more than one partition to union
+_pools = {}
+
+def _worker_pool(workers):
+    pool = _pools.get(workers)
+    if pool is None:
+        pool = _pools[workers] = Pool(workers)
+    return pool
+
+def _terminate_pool(workers):
+    pool = _pools.pop(workers, None)
+    if pool is not None:
+        pool.terminate()
+
+def _terminate_pools():
+    for workers in list(_pools):
+        _terminate_pool(workers)
+
+atexit.register(_terminate_pools)
+
+def _union_wkbs(wkbs):
+    # unions a list of wkb blobs, run in a worker process so must be module level
+    shapes = []
+    for wkb in wkbs:
+        geom = Geometry(wkb)
+        geom._load_shapely()
+        shapes.append(geom._shp)
+    return unary_union(shapes).wkb
+
+class ST_ParallelUnion(object):
+    '''
+    st_ParallelUnion(geom, [workers=cpu count, memory_mb=256])
+
+    Buffers the input wkb until memory_mb is reached, then splits the buffered geoms
+    into one spatial partition per worker (sort-tile-recursive on the bbox centers)
+    and unions each partition in a process pool. The partial results are finally merged
+    pairwise in a tree, so no single union grows with the number of inputs.
+    '''
+    def __init__(self):
+        self.workers = None
+        self.maxbytes = None
+        self.usedpool = False
+        self.items = []
+        self.nbytes = 0
+        self.partials = []
+
+    def step(self, wkb, workers=None, memory_mb=None):
+        # sqlite never calls finalize if step fails, so clean up here
+        try:
+            self._step(wkb, workers, memory_mb)
+        except:
+            self._abort()
+            raise
+
+    def _step(self, wkb, workers, memory_mb):
+        if wkb is None:
+            return
+        if self.workers is None:
+            # options are read from the first row
+            self.workers = workers or cpu_count()
+            self.maxbytes = int((memory_mb or 256) * 1024 * 1024)
 
-CACHE = dict()
+        geom = Geometry(wkb)
+        xmin,ymin,xmax,ymax = geom.bbox()
+        data = geom._wkb.tobytes()
+        self.items.append(((xmin+xmax)/2.0, (ymin+ymax)/2.0, data))
+        self.nbytes += len(data)
+        if self.nbytes >= self.maxbytes:
+            self._flush()
+
+    def _pool(self, ntasks):
+        # the shared pool, or None if the tasks are not worth sending to other processes
+        if self.workers > 1 and ntasks > 1:
+            self.usedpool = True
+            return _worker_pool(self.workers)
+
+    def _abort(self):
+        # drop the buffered work, and stop any of it still running in the pool
+        # (a failing step or finalize aborts the whole query, so no other aggregate needs the pool)
+        self.items = []
+        self.partials = []
+        if self.usedpool:
+            _terminate_pool(self.workers)
+            self.usedpool = False
+
+    def _partitions(self):
+        # sort-tile-recursive: vertical slices by x, then split each slice by y
+        nparts = min(self.workers, len(self.items))
+        slices = int(math.ceil(math.sqrt(nparts)))
+        items = sorted(self.items, key=lambda item: item[0])
+        slicesize = int(math.ceil(len(items) / float(slices)))
+        partitions = []
+        for i in range(0, len(items), slicesize):
+            slc = sorted(items[i:i+slicesize], key=lambda item: item[1])
+            partsize = int(math.ceil(len(slc) / float(slices)))
+            for j in range(0, len(slc), partsize):
+                partitions.append([data for _,_,data in slc[j:j+partsize]])
+        return partitions
+
+    def _flush(self):
+        if not self.items:
+            return
+        partitions = self._partitions()
+        pool = self._pool(len(partitions))
+        for partition in partitions:
+            if pool:
+                self.partials.append(pool.apply_async(_union_wkbs, (partition,)))
+            else:
+                self.partials.append(_union_wkbs(partition))
+        self.items = []
+        self.nbytes = 0
+
+    def finalize(self):
+        try:
+            self._flush()
+            if not self.partials:
+                return None
+            partials = [res if isinstance(res, bytes) else res.get()
+                        for res in self.partials]
+            self.partials = []
+
+            # merge partial results in a tree
+            while len(partials) > 1:
+                pairs = [partials[i:i+2] for i in range(0, len(partials), 2)]
+                pool = self._pool(len(pairs))
+                if pool:
+                    partials = pool.map(_union_wkbs, pairs)
+                else:
+                    partials = [_union_wkbs(pair) for pair in pairs]
+
+            resultgeom = Geometry(partials[0])
+            return resultgeom.dump_wkb()
+
+        except:
+            self._abort()
+            raise
+
+# class
 
 class Geometry(object):
 
-    def __init__(self, wkb=None, shp=None):
+    def __init__(self, wkb=None, shp=None, cache=None):
+        self._blob = None
+        self._bbox = None
+        self._srid = None
         if wkb:
             wkb = memoryview(wkb)
+            if is_gpb(wkb):
+                # blob with embedded srid and bbox, followed by the actual wkb
+                self._blob = wkb
+                self._srid,self._bbox,offset = read_gpb_header(wkb)
+                wkb = wkb[offset:]
         self._wkb = wkb
         self._shp = shp
+        self._cache = cache
+        self._prepared = None
 
     def _load_shapely(self):
         '''wkb buffer to shapely'''
-        # TODO: its possible that each reference to geom column in query creates a new geom instance from the db for each
-        # in that case, storing ._shp doesnt help and shapely creation becomes very duplicative
-        # explore accessing a dict of cached geometry instances based on the wkb bytes?
-##        wkb_bytes = self._wkb.tobytes()
-##        cached = CACHE.get(wkb_bytes, None)
-##        if cached:
-##            #print 'getting cached'
-##            shp = cached
-##        else:
-##            #print 'loading new'
-##            shp = wkb_loads(wkb_bytes)
-##            CACHE[wkb_bytes] = shp
-##        self._shp = shp
-
-        # non-cache approach
-        self._shp = wkb_loads(self._wkb.tobytes())
+        if self._cache is not None:
+            # each reference to a geom column in a query creates a new geom instance,
+            # so look for an already loaded version of the same wkb bytes
+            self._shp = self._cache.load(self._wkb)
+        else:
+            self._shp = wkb_loads(self._wkb.tobytes())
+
+    def _set_prepared(self, prepared, bbox=None):
+        # shapely prepared geometry, used instead of _shp in predicates,
+        # along with its already known bbox
+        if prepared is not None:
+            self._prepared = prepared
+            self._shp = prepared.context
+            if bbox is not None:
+                self._bbox = bbox
 
     # dont require shapely (ie reading binary directly)
 
     def type(self):
-        if self._shp:
+        if self._shp is not None:
             return self._shp.geom_type
         else:
-            byteorder = _wkb_byteorder(self._wkb)
-            typ = unpack_from(byteorder+'xi', self._wkb)[0]
+            _,typ,_,_ = read_header(self._wkb)
             typ = wkbtype_to_shptype[typ]
             return typ
 
+    def srid(self):
+        if self._srid is not None:
+            return self._srid
+        elif self._wkb:
+            # ewkb may have an embedded srid
+            byteorder,_,_,offset = read_header(self._wkb)
+            (typ,) = unpack_from(byteorder+'I', self._wkb, 1)
+            if typ & 0x20000000:
+                (srid,) = unpack_from(byteorder+'i', self._wkb, offset-4)
+                return srid
+        return 0
+
     def bbox(self):
-        if self._shp:
+        if self._bbox is not None:
+            # embedded in the blob header
+            return self._bbox
+        elif self._shp is not None:
             # shapely already loaded, fastest to let shapely do it
             xmin,ymin,xmax,ymax = self._shp.bounds
             return xmin,ymin,xmax,ymax
         else:
             # create directly from wkb, avoid overhead of converting to shapely
-            # OR MAYBE PYTHON BBOX IS TOO SLOW? TEST!
-            
+            # finds the offsets of all coordinate sequences and reduces them as numpy views
             # available funcs:
             # https://postgis.net/docs/PostGIS_Special_Functions_Index.html#PostGIS_BoxFunctions
-            # wkb structure
-            # https://www.gaia-gis.it/gaia-sins/BLOB-Geometry.html
-            # NOTE: maybe its not worth it, loading to shapely might be faster
-            # ...
-            # NOTE: actually is ca 10% faster than shapely for complex polys, and 5x for points. 
-            # TODO: switch to faster version, build fmt string and unpack all coords in one call
-            # ...
-
-            # funky testing of polygon type (faster)
-    ##        fmt = ''
-    ##        byteorder = _wkb_byteorder(wkb)
-    ##        fmt += 'x'
-    ##        off = 1
-    ##        wkbtyp = unpack_from(byteorder+'i', wkb, off)[0]
-    ##        fmt += '4x'
-    ##        off += 4
-    ##        num = unpack_from(byteorder+'i', wkb, off)[0]
-    ##        fmt += '4x'
-    ##        off += 4
-    ##        
-    ##        for i in range(num):
-    ##            pnum = unpack_from(byteorder+'i', wkb, off)[0]
-    ##            #fmt += '4x' + 'dd'*pnum
-    ##            if i == 0:
-    ##                # exterior
-    ##                fmt += '4x' + '{}d'.format(pnum*2)
-    ##            else:
-    ##                # ignore hole
-    ##                fmt += '4x' + '{}x'.format(pnum*2*8)
-    ##            off += 4 + 16*pnum
-    ##        #print num,fmt
-    ##        flat = unpack_from(byteorder+fmt, wkb)
-    ##        #xs,ys = flat[0::2],flat[1::2]
-    ##
-    ##        self.xmin = min(islice(flat,0,None,2))
-    ##        self.ymin = min(islice(flat,1,None,2))
-    ##        self.xmax = max(islice(flat,0,None,2))
-    ##        self.ymax = max(islice(flat,1,None,2))
-    ##
-    ##        return
-
-            # real is below...
-            def ringbox(stream):
-                pnum = unpack(byteorder+'i', stream.read(4))[0]
-                flat = unpack(byteorder+'{}d'.format(pnum*2), stream.read(16*pnum))
-                #xs,ys = flat[0::2],flat[1::2]
-                #return min(xs),min(ys),max(xs),max(ys)
-                return (min(islice(flat,0,None,2)),
-                        min(islice(flat,1,None,2)),
-                        max(islice(flat,0,None,2)),
-                        max(islice(flat,1,None,2)) )
-            
-            def polybox(stream):
-                # only check exterior, ie the first ring
-                #print 'poly tell',stream.tell()
-                num = unpack(byteorder+'i', stream.read(4))[0]
-                xmin,ymin,xmax,ymax = ringbox(stream)
-                # skip holes, ie remaining rings
-                if num > 1:
-                    for _ in range(num-1):
-                        pnum = unpack(byteorder+'i', stream.read(4))[0]
-                        unpack(byteorder+'{}x'.format(pnum*2*8), stream.read(16*pnum))
-                return xmin,ymin,xmax,ymax
-            
-            def multi(stream):
-                # 1 byte and one 4bit int class type of 1,2,3: point line or poly
-                stream.read(5)
-                return stream
-
-            stream = BytesIO(self._wkb)
-            byteorder = _wkb_byteorder(stream.read(1))
-            wkbtyp = unpack(byteorder+'i', stream.read(4))[0]
-            typ = wkbtype_to_shptype[wkbtyp]
-            if typ == 'Point':
-                x,y = unpack(byteorder+'dd', stream.read(8*2))
-                xmin = xmax = x
-                ymin = ymax = y
-            elif typ == 'LineString':
-                xmin,ymin,xmax,ymax = ringbox(stream)
-            elif typ == 'Polygon':
-                xmin,ymin,xmax,ymax = polybox(stream)
-            elif typ == 'MultiPoint':
-                num = unpack(byteorder+'i', stream.read(4))[0]
-                flat = unpack(byteorder+'5xdd'*(num), stream.read((5+16)*num))
-                xmin,ymin,xmax,ymax = (min(islice(flat,0,None,2)),
-                                        min(islice(flat,1,None,2)),
-                                        max(islice(flat,0,None,2)),
-                                        max(islice(flat,1,None,2)) )
-            elif typ == 'MultiLineString':
-                num = unpack(byteorder+'i', stream.read(4))[0]
-                xmins,ymins,xmaxs,ymaxs = zip(*(ringbox(multi(stream)) for _ in range(num)))
-                xmin,ymin,xmax,ymax = min(xmins),min(ymins),max(xmaxs),max(ymaxs)
-            elif typ == 'MultiPolygon':
-                num = unpack(byteorder+'i', stream.read(4))[0]
-                xmins,ymins,xmaxs,ymaxs = zip(*(polybox(multi(stream)) for _ in range(num)))
-                xmin,ymin,xmax,ymax = min(xmins),min(ymins),max(xmaxs),max(ymaxs)
-            else:
-                raise NotImplementedError('Geometry bbox calculation of type {}'.format(typ))
-
-            return xmin,ymin,xmax,ymax
+            return read_bbox(self._wkb)
 
     def box2d(self):
         xmin,ymin,xmax,ymax = self.bbox()
-        pointbox = Geometry(shp=MultiPoint([(xmin,ymin),(xmax,ymax)]))
+        pointbox = Geometry(write_box2d(xmin,ymin,xmax,ymax))
         return pointbox
 
     def envelope(self):
         xmin,ymin,xmax,ymax = self.bbox()
-        polygon = Geometry(shp=Polygon([(xmin,ymin),(xmin,ymax),(xmax,ymax),(xmax,ymin),(xmin,ymin)]))
+        polygon = Geometry(write_polygon([[(xmin,ymin),(xmin,ymax),(xmax,ymax),(xmax,ymin),(xmin,ymin)]]))
         return polygon
 
     def expand(self, units):
-        xmin,ymin,xmax,ymax = self.bbox()
-        w = xmax-xmin
-        h = ymax-ymin
-        xmin -= units
-        xmax += units
-        ymin -= units
-        ymax += units
-        pointbox = Geometry(shp=MultiPoint([(xmin,ymin),(xmax,ymax)]))
+        xmin,ymin,xmax,ymax = _expand_bbox(self.bbox(), units)
+        pointbox = Geometry(write_box2d(xmin,ymin,xmax,ymax))
         return pointbox
 
+    def _parsed(self):
+        # nested (type, dims, coords) numpy views over the wkb
+        return read_geometry(self.dump_wkb(plain=True))[0]
+
     def area(self):
-        # temp
-        if not self._shp:
-            self._load_shapely()
-        return self._shp.area
-        
-##        if self._shp:
-##            # shapely already loaded, fastest to let shapely do it
-##            return self._shp.area
-##        else:
-##            # create directly from wkb, avoid overhead of converting to shapely
-##            # OR MAYBE PYTHON AREA IS TOO SLOW? TEST! 
-##            raise NotImplemented
+        if self._shp is not None:
+            # shapely already loaded, fastest to let shapely do it
+            return self._shp.area
+        else:
+            # create directly from wkb, avoid overhead of converting to shapely
+            return measure.area(self._parsed())
+
+    def length(self):
+        # only linear geometries have length, same as postgis
+        return measure.length(self._parsed())
+
+    def perimeter(self):
+        # only areal geometries have perimeter, same as postgis
+        return measure.perimeter(self._parsed())
 
     # representation
 
-    def as_WKT(self):
-        # temp solution
-        if not self._shp:
-            self._load_shapely()
-        return self._shp.wkt
-    
-##        if self._shp:
-##            # shapely already loaded, fastest to let shapely do it
-##            return self._shp.__geo_interface__
-##        else:
-##            # create directly from wkb, avoid overhead of converting to shapely
-##            raise NotImplemented
-
-    def as_GeoJSON(self):
-        # temp solution
-        if not self._shp:
-            self._load_shapely()
-        return self._shp.__geo_interface__
-    
-##        if self._shp:
-##            # shapely already loaded, fastest to let shapely do it
-##            return self._shp.__geo_interface__
-##        else:
-##            # create directly from wkb, avoid overhead of converting to shapely
-##            raise NotImplemented
+    def as_WKT(self, precision=None):
+        # precision is the max number of decimals, None for full precision
+        if self._wkb is not None:
+            # create directly from wkb, avoid overhead of converting to shapely
+            return write_wkt(read_geometry(self._wkb)[0], precision)
+        else:
+            return self._shp.wkt
+
+    def as_GeoJSON(self, precision=None):
+        if self._shp is not None and precision is None:
+            # shapely already loaded, fastest to let shapely do it
+            return self._shp.__geo_interface__
+        else:
+            # create directly from wkb, avoid overhead of converting to shapely
+            return geojson_dict(self._parsed(), precision)
+
+    def dump_geojson(self, precision=None):
+        # geojson string, written directly from wkb
+        if self._wkb is None:
+            return json.dumps(self.as_GeoJSON(precision))
+        return write_geojson(read_geometry(self._wkb)[0], precision)
 
     def as_SVG(self):
         # create directly from wkb
@@ -375,17 +481,18 @@ class Geometry(object):
         '''
         Group 1:
             Variant 1:
-                refraster, pixeltype, [value=1, nodataval=0]
+                refraster, pixeltype, [value=1, nodataval=0, touched=False]
         Group 2:
             Variant 2:
                 ...
             Variant 3:
-                scalex, scaley, pixeltype, [value=1, nodataval=0, upperleftx=NULL, upperlefty=NULL, skewx=0, skewy=0]
+                scalex, scaley, pixeltype, [value=1, nodataval=0, upperleftx=NULL, upperlefty=NULL, skewx=0, skewy=0, touched=False]
         Group 3:
             Variant 4:
                 ...
             Variant 5:
-                width, height, pixeltype, [value=1, nodataval=0, upperleftx=NULL, upperlefty=NULL, skewx=0, skewy=0
+                width, height, pixeltype, [value=1, nodataval=0, upperleftx=NULL, upperlefty=NULL, skewx=0, skewy=0, touched=False]
+        With touched, all pixels touched by polygon outlines are burned, not just those with their centre inside.
         '''
         from ..raster.raster import Raster, make_empty_raster
 
@@ -409,6 +516,7 @@ class Geometry(object):
             pixeltype = args[1]
             value = getarg(args, 2, 1) 
             nodataval = getarg(args, 3, 0)
+            touched = getarg(args, 4, False)
             
         # GROUP 2: set params, autocalc width/height
         elif isinstance(args[0], float) and isinstance(args[2], float):
@@ -420,6 +528,7 @@ class Geometry(object):
             nodataval = getarg(args, 6, 0) 
             skewX = getarg(args, 7, 0.0) 
             skewY = getarg(args, 8, 0.0)
+            touched = getarg(args, 9, False)
 
             xmin,ymin,xmax,ymax = self.bbox()
             width = abs(xmax-xmin) / float(scaleX)
@@ -452,6 +561,7 @@ class Geometry(object):
             upperLeftY = getarg(args, 6, ymax) # flipped y by default
             skewX = getarg(args, 7, 0.0) 
             skewY = getarg(args, 8, 0.0) 
+            touched = getarg(args, 9, False)
             width = abs(xmax-xmin) / float(scaleX)
             height = abs(ymax-ymin) / float(scaleY)
             width = int(round(abs(width)))
@@ -469,6 +579,7 @@ class Geometry(object):
             nodataval = getarg(args, 6, 0) 
             skewX = getarg(args, 7, 0.0) 
             skewY = getarg(args, 8, 0.0)
+            touched = getarg(args, 9, False)
 
             xmin,ymin,xmax,ymax = self.bbox()
             scaleX = abs(xmax-xmin) / float(width)
@@ -495,6 +606,7 @@ class Geometry(object):
             upperLeftY = getarg(args, 6, ymax) # flipped y by default
             skewX = getarg(args, 7, 0.0) 
             skewY = getarg(args, 8, 0.0) 
+            touched = getarg(args, 9, False)
             scaleX = abs(xmax-xmin) / float(width)
             scaleY = abs(ymax-ymin) / float(height) * -1 # flipped y by default
             
@@ -503,67 +615,28 @@ class Geometry(object):
         else:
             raise Exception('Invalid function args: {}'.format(args))
 
-        # create drawer
+        # burn the geometry directly into an array of the band pixeltype
         import numpy as np
-        from PIL import Image,ImageDraw,ImagePath
-        mode = {'b1':'1', 'u1':'L', 'i4':'I', 'f8':'F'}[pixeltype]
-        img = Image.new(mode, (ref.width, ref.height), nodataval)
-        drawer = ImageDraw.Draw(img)
-
-        # get the raster's inverse affine to use for drawing
-        a,b,c,d,e,f,_,_,_ = list(~ref._affine) 
-
-        # set burn values
-        fill = value
-        outline = None
-        holefill = nodataval
-        holeoutline = None
-        #print ["burnmain",fill,outline,"burnhole",holefill,holeoutline]
-
-        # make all multis so can treat all same
-        geoj = self.as_GeoJSON()
-        geotype = geoj['type']
-        coords = geoj["coordinates"]
-        if not "Multi" in geotype:
-            coords = [coords]
-
-        # polygon, basic black fill, no outline
-        if "Polygon" in geotype:
-            for poly in coords:
-                # exterior
-                exterior = [tuple(p) for p in poly[0]]
-                path = ImagePath.Path(exterior)
-                #print list(path)[:10]
-                path.transform((a,b,c,d,e,f))
-                #print list(path)[:10]
-                drawer.polygon(path, fill=fill, outline=outline)
-                # holes
-                if len(poly) > 1:
-                    for hole in poly[1:]:
-                        hole = [tuple(p) for p in hole]
-                        path = ImagePath.Path(hole)
-                        path.transform((a,b,c,d,e,f))
-                        drawer.polygon(path, fill=holefill, outline=holeoutline)
-                        
-        # line, 1 pixel line thickness
-        elif "LineString" in geotype:
-            for line in coords:
-                path = ImagePath.Path(line)
-                path.transform((a,b,c,d,e,f))
-                drawer.line(path, fill=fill)
-            
-        # point, 1 pixel square size
-        elif "Point" in geotype:
-            path = ImagePath.Path(coords)
-            path.transform((a,b,c,d,e,f))
-            drawer.point(path, fill=fill)
-
-        # make raster from drawn img
+        from ..raster.rasterize import geometry_mask
+        if not ref._header:
+            ref._load_header()
+        invaffine = list(~ref._affine)[:6]
+        mask = geometry_mask(self._parsed(), invaffine, ref.width, ref.height, touched)
+        arr = np.full((ref.height, ref.width), nodataval, dtype=np.dtype(pixeltype))
+        arr[mask] = value
+
+        # make raster from burned array
+        # edit and write raster header from scratch, with the one band
         out = make_empty_raster(ref)
         out._load_header()
-        arr = np.array(img)
+        header = out._header.copy()
+        endianFmt = header['endian']
+        header['endian'] = 1 if header['endian'] == '<' else 0
+        header['numbands'] = 1
+        headervals = [header[k] for k in 'version,numbands,scaleX,scaleY,ipX,ipY,skewX,skewY,srid,width,height'.split(',')]
+        wkb = pack('<b', header['endian'])
+        wkb += pack(endianFmt + 'HHddddddIHH', *headervals)
         # TODO: prob outsource to builtin add_band() method
-        wkb = out._wkb.tobytes()
         dtypes = ['b1', 'u1', 'u1', 'i1', 'u1', 'i2',
                   'u2', 'i4', 'u4', 'f4', 'f8']
         pixeltypenum = dtypes.index(pixeltype)
@@ -574,82 +647,130 @@ class Geometry(object):
                       'nodata': nodataval,
                       }
         wkb += out._write_band_header(bandheader)
-        wkb += arr.tostring()
+        wkb += arr.tobytes()
 
         wkb_mem = memoryview(wkb)
         rast = Raster(wkb_mem)
         return rast
             
 
+    def box_distance(self, othergeom):
+        '''Distance between the bboxes, a cheap lower bound for the real distance'''
+        return _bbox_distance(self.bbox(), othergeom.bbox())
+
     # require shapely
 
+    def _prefilter_bbox(self):
+        # bbox for the quick bbox tests, or None if it cant be read directly from the wkb
+        # in which case the exact test is left to shapely
+        try:
+            return self.bbox()
+        except Exception:
+            return None
+
+    def _bboxes_disjoint(self, othergeom, dist=0):
+        # true only if both bboxes could be read and dont overlap (within dist)
+        bbox,otherbbox = self._prefilter_bbox(), othergeom._prefilter_bbox()
+        if bbox is None or otherbbox is None:
+            return False
+        if dist:
+            bbox = _expand_bbox(bbox, dist)
+        return not _bbox_intersects(bbox, otherbbox)
+
     def intersects(self, othergeom):
-        if not self._shp:
+        # quick reject if bboxes dont overlap, avoids loading shapely
+        if self._bboxes_disjoint(othergeom):
+            return False
+        if self._shp is None:
             self._load_shapely()
-        if not othergeom._shp:
+        if othergeom._shp is None:
             othergeom._load_shapely()
-        res = self._shp.intersects(othergeom._shp)
+        if othergeom._prepared is not None:
+            res = othergeom._prepared.intersects(self._shp)
+        elif self._prepared is not None:
+            res = self._prepared.intersects(othergeom._shp)
+        else:
+            res = self._shp.intersects(othergeom._shp)
         return res
 
     def disjoint(self, othergeom):
-        if not self._shp:
+        # quick accept if bboxes dont overlap, avoids loading shapely
+        if self._bboxes_disjoint(othergeom):
+            return True
+        if self._shp is None:
             self._load_shapely()
-        if not othergeom._shp:
+        if othergeom._shp is None:
             othergeom._load_shapely()
-        res = self._shp.disjoint(othergeom._shp)
+        if othergeom._prepared is not None:
+            res = othergeom._prepared.disjoint(self._shp)
+        elif self._prepared is not None:
+            res = self._prepared.disjoint(othergeom._shp)
+        else:
+            res = self._shp.disjoint(othergeom._shp)
         return res
 
+    def dwithin(self, othergeom, dist):
+        # quick reject if the bbox expanded by dist doesnt overlap the other bbox, avoids loading shapely
+        if self._bboxes_disjoint(othergeom, dist):
+            return False
+        return self.distance(othergeom) <= dist
+
     def distance(self, othergeom):
-        if not self._shp:
+        # the bbox distance is only a lower bound, except between two points where it is exact
+        if self.type() == 'Point' and othergeom.type() == 'Point':
+            return self.box_distance(othergeom)
+        if self._shp is None:
             self._load_shapely()
-        if not othergeom._shp:
+        if othergeom._shp is None:
             othergeom._load_shapely()
         res = self._shp.distance(othergeom._shp)
         return res
 
     def centroid(self):
-        if not self._shp:
-            self._load_shapely()
-        shp = self._shp.centroid
-        geom = Geometry(shp=shp)
+        # calculated directly from wkb
+        xy = measure.centroid(self._parsed())
+        if xy is None:
+            # empty point
+            xy = float('nan'),float('nan')
+        geom = Geometry(write_point(*xy))
         return geom
 
     def buffer(self, dist):
-        if not self._shp:
+        if self._shp is None:
             self._load_shapely()
         shp = self._shp.buffer(dist)
         geom = Geometry(shp=shp)
         return geom
 
     def intersection(self, othergeom):
-        if not self._shp:
+        if self._shp is None:
             self._load_shapely()
-        if not othergeom._shp:
+        if othergeom._shp is None:
             othergeom._load_shapely()
         shp = self._shp.intersection(othergeom._shp)
         geom = Geometry(shp=shp)
         return geom
 
     def difference(self, othergeom):
-        if not self._shp:
+        if self._shp is None:
             self._load_shapely()
-        if not othergeom._shp:
+        if othergeom._shp is None:
             othergeom._load_shapely()
         shp = self._shp.difference(othergeom._shp)
         geom = Geometry(shp=shp)
         return geom
 
     def union(self, othergeom):
-        if not self._shp:
+        if self._shp is None:
             self._load_shapely()
-        if not othergeom._shp:
+        if othergeom._shp is None:
             othergeom._load_shapely()
         shp = self._shp.union(othergeom._shp)
         geom = Geometry(shp=shp)
         return geom
 
     def simplify(self, tolerance, preserve_topology=True):
-        if not self._shp:
+        if self._shp is None:
             self._load_shapely()
         shp = self._shp.simplify(tolerance, preserve_topology=preserve_topology)
         geom = Geometry(shp=shp)
@@ -657,10 +778,13 @@ class Geometry(object):
     
     # serializing
 
-    def dump_wkb(self):
+    def dump_wkb(self, plain=False):
         # geometry memoryview to sqlite3 db blob
         # py2: db requires buffer, py3: db requires memview
-        if self._wkb:
+        # unless plain is set, blobs with embedded bbox are dumped as is
+        if self._blob and not plain:
+            wkb_mem = self._blob
+        elif self._wkb:
             # use existing wkb
             wkb_mem = self._wkb
         elif self._shp != None:
@@ -675,6 +799,20 @@ class Geometry(object):
             wkb_mem = buffer(wkb_mem.tobytes())
         return Binary(wkb_mem)
 
+    def dump_gpb(self, srid=None):
+        # geometry to sqlite3 db blob with embedded srid and bbox
+        if self._blob and srid is None:
+            return self.dump_wkb()
+        wkb_mem = self.dump_wkb(plain=True)
+        if wkb_mem is None:
+            return None
+        if srid is None:
+            srid = self.srid()
+        blob = write_gpb(wkb_mem, self.bbox(), srid)
+        if PY2:
+            blob = buffer(blob)
+        return Binary(blob)
+
 
 
 
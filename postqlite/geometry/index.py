@@ -0,0 +1,161 @@
+
+# spatial index for geom columns, using sqlite's builtin rtree virtual table
+# the rtree is kept up to date by insert/update/delete triggers that call the
+# st_Xmin/st_Ymin/st_Xmax/st_Ymax funcs, which means the table must only be
+# modified via connections that have the postqlite funcs registered, ie postqlite.connect()
+
+from struct import unpack_from
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def spatial_index_name(table, column):
+    # same naming convention as spatialite
+    return 'idx_{}_{}'.format(table, column)
+
+
+def has_spatial_index(conn, table, column):
+    idxname = spatial_index_name(table, column)
+    row = conn.execute("select 1 from sqlite_master where type = 'table' and name = ?", (idxname,)).fetchone()
+    return row is not None
+
+
+def create_spatial_index(conn, table, column):
+    '''Creates an rtree index on the bboxes of a geom column, and triggers to keep it updated.
+    The index is a virtual table named idx_<table>_<column> with columns (id, xmin, xmax, ymin, ymax),
+    where id is the rowid of the indexed table, and can be joined in queries like:
+
+        select t.* from t, idx_t_geom as i
+        where t.rowid = i.id
+        and i.xmax >= 0 and i.xmin <= 10 and i.ymax >= 0 and i.ymin <= 10
+    '''
+    idxname = spatial_index_name(table, column)
+    if has_spatial_index(conn, table, column):
+        raise Exception('Spatial index {} already exists'.format(idxname))
+
+    params = dict(idx=_quote(idxname),
+                  table=_quote(table),
+                  col=_quote(column),
+                  trig_insert=_quote(idxname + '_insert'),
+                  trig_update=_quote(idxname + '_update'),
+                  trig_delete=_quote(idxname + '_delete'),
+                  )
+
+    # create the rtree
+    conn.execute('create virtual table {idx} using rtree(id, xmin, xmax, ymin, ymax)'.format(**params))
+
+    # populate with existing rows
+    conn.execute('''insert into {idx} (id, xmin, xmax, ymin, ymax)
+                    select rowid, st_Xmin({col}), st_Xmax({col}), st_Ymin({col}), st_Ymax({col})
+                    from {table}
+                    where {col} is not null and st_Xmin({col}) is not null'''.format(**params))
+
+    # keep updated
+    # empty geoms have no bbox and are left out, rather than indexed as (0,0,0,0)
+    # updates of any column are tracked, since the rowid itself may change
+    conn.execute('''create trigger {trig_insert} after insert on {table}
+                    when new.{col} is not null and st_Xmin(new.{col}) is not null
+                    begin
+                        insert into {idx} (id, xmin, xmax, ymin, ymax)
+                        values (new.rowid, st_Xmin(new.{col}), st_Xmax(new.{col}), st_Ymin(new.{col}), st_Ymax(new.{col}));
+                    end'''.format(**params))
+    conn.execute('''create trigger {trig_update} after update on {table}
+                    begin
+                        delete from {idx} where id = old.rowid;
+                        insert into {idx} (id, xmin, xmax, ymin, ymax)
+                        select new.rowid, st_Xmin(new.{col}), st_Xmax(new.{col}), st_Ymin(new.{col}), st_Ymax(new.{col})
+                        where new.{col} is not null and st_Xmin(new.{col}) is not null;
+                    end'''.format(**params))
+    conn.execute('''create trigger {trig_delete} after delete on {table}
+                    begin
+                        delete from {idx} where id = old.rowid;
+                    end'''.format(**params))
+
+    conn.commit()
+
+
+def drop_spatial_index(conn, table, column):
+    idxname = spatial_index_name(table, column)
+    for suffix in ('_insert', '_update', '_delete'):
+        conn.execute('drop trigger if exists {}'.format(_quote(idxname + suffix)))
+    conn.execute('drop table if exists {}'.format(_quote(idxname)))
+    conn.commit()
+
+
+def query_spatial_index(conn, table, column, bbox):
+    '''Returns the rowids of all rows whose bbox intersects the given bbox (xmin,ymin,xmax,ymax)'''
+    idxname = spatial_index_name(table, column)
+    xmin,ymin,xmax,ymax = bbox
+    sql = 'select id from {} where xmax >= ? and xmin <= ? and ymax >= ? and ymin <= ?'.format(_quote(idxname))
+    return [rowid for (rowid,) in conn.execute(sql, (xmin, xmax, ymin, ymax))]
+
+
+def _root_node(conn, table, column):
+    # the cells of the rtree root node, each a (id, xmin, xmax, ymin, ymax) bbox covering a subtree,
+    # together with the depth of the tree below the root
+    # see the node format in: https://www.sqlite.org/src/file/ext/rtree/rtree.c
+    idxname = spatial_index_name(table, column)
+    (data,) = conn.execute('select data from {} where nodeno = 1'.format(_quote(idxname + '_node'))).fetchone()
+    data = bytes(data)
+    depth,count = unpack_from('>HH', data, 0)
+    cells = [unpack_from('>qffff', data, 4 + i*24) for i in range(count)]
+    return depth, cells
+
+
+def spatial_index_extent(conn, table, column):
+    '''Returns the (xmin,ymin,xmax,ymax) extent of an indexed geom column, read from the root of the index alone.
+    Note that the index stores 32-bit floats, rounded outwards, so the extent may be slightly larger.'''
+    depth,cells = _root_node(conn, table, column)
+    if not cells:
+        return None
+    xmin = min([cell[1] for cell in cells])
+    xmax = max([cell[2] for cell in cells])
+    ymin = min([cell[3] for cell in cells])
+    ymax = max([cell[4] for cell in cells])
+    return xmin,ymin,xmax,ymax
+
+
+def cluster_table(conn, table, column, extent=None, bits=16, curve='hilbert'):
+    '''Rewrites all rows of a table in hilbert (or zorder) order of the bbox centres of a geom column,
+    so that spatially close rows are stored on the same database pages.
+    The extent (xmin,ymin,xmax,ymax) defaults to that of the column.
+    Rows get new rowids in the new order, so tables with an integer primary key cannot be clustered.
+    Indexes and triggers are kept, and any spatial index is rebuilt.
+    Run vacuum afterwards to also defragment the database file.'''
+    for _,name,typ,_,_,pk in conn.execute('pragma table_info({})'.format(_quote(table))):
+        if pk and typ.upper() == 'INTEGER':
+            raise Exception('Cannot cluster table {}, its integer primary key {} determines the row order'.format(table, name))
+
+    if extent is None:
+        sql = 'select min(st_Xmin({col})), min(st_Ymin({col})), max(st_Xmax({col})), max(st_Ymax({col})) from {table}'
+        extent = conn.execute(sql.format(col=_quote(column), table=_quote(table))).fetchone()
+        if extent[0] is None:
+            # nothing to order by
+            return
+    funcname = {'hilbert': 'st_HilbertKey', 'zorder': 'st_ZOrderKey'}[curve]
+
+    # indexes and triggers are dropped while rewriting, and recreated afterwards
+    spatial = has_spatial_index(conn, table, column)
+    if spatial:
+        drop_spatial_index(conn, table, column)
+    objects = conn.execute('''select type, name, sql from sqlite_master
+                              where tbl_name = ? and type in ('index','trigger') and sql is not null''', (table,)).fetchall()
+    for typ,name,_ in objects:
+        conn.execute('drop {} {}'.format(typ, _quote(name)))
+
+    # copy out in curve order and back again, which assigns new rowids in that order
+    params = dict(table=_quote(table), col=_quote(column), func=funcname, tmp=_quote('_cluster_' + table))
+    conn.execute('''create temp table {tmp} as select * from {table}
+                    order by {func}({col}, st_MakeEnvelope(?,?,?,?), ?)'''.format(**params), tuple(extent) + (bits,))
+    conn.execute('delete from {table}'.format(**params))
+    conn.execute('insert into {table} select * from {tmp} order by rowid'.format(**params))
+    conn.execute('drop table {tmp}'.format(**params))
+
+    for _,_,sql in objects:
+        conn.execute(sql)
+    conn.commit()
+    if spatial:
+        create_spatial_index(conn, table, column)
+
@@ -0,0 +1,130 @@
+
+# bulk spatial joins between two geom columns, using a shapely STRtree over the smaller side
+# instead of calling a predicate func once for every pair of rows.
+# sqlite3 in python has no way to define table-valued functions, so the sql func st_SpatialJoin
+# returns the matching (left rowid, right rowid) pairs as a json array, which can be expanded with json_each:
+#
+#     select json_extract(j.value, '$[0]') as parcel_id, json_extract(j.value, '$[1]') as zone_id
+#     from json_each(st_SpatialJoin('parcels', 'geom', 'zones', 'geom', 'intersects')) as j
+#
+# for very large joins, use spatial_join() with into= to write the pairs to a table instead.
+
+import json
+
+import shapely
+from shapely.wkb import loads as wkb_loads
+from shapely.strtree import STRtree
+from shapely.prepared import prep
+
+from .index import _quote
+
+
+# shapely 2 can query the tree for a whole array of geometries at once
+SHAPELY2 = hasattr(shapely, 'from_wkb')
+
+# the predicate with the arguments swapped, ie pred(a,b) == converse(b,a)
+_CONVERSE = {'intersects': 'intersects',
+             'touches': 'touches',
+             'crosses': 'crosses',
+             'overlaps': 'overlaps',
+             'contains': 'within',
+             'within': 'contains',
+             'covers': 'covered_by',
+             'covered_by': 'covers'}
+
+
+def register_funcs(conn):
+    # into= is left out, since writing tables from inside a running query is not allowed
+    func = lambda *args: json.dumps([list(pair) for pair in spatial_join(conn, *args)])
+    conn.create_function('st_SpatialJoin', 4, func) # left, leftcolumn, right, rightcolumn
+    conn.create_function('st_SpatialJoin', 5, func) # + predicate
+    conn.create_function('st_SpatialJoin', 6, func) # + chunksize
+
+
+def _count(conn, table, column):
+    sql = 'select count(*) from {table} where {col} is not null'.format(col=_quote(column), table=_quote(table))
+    return conn.execute(sql).fetchone()[0]
+
+def _read_chunks(conn, table, column, chunksize):
+    # yields lists of rowids and plain wkb bytes, any embedded bbox header is stripped by st_AsBinary
+    sql = 'select rowid, st_AsBinary({col}) from {table} where {col} is not null'.format(col=_quote(column), table=_quote(table))
+    cur = conn.execute(sql)
+    while True:
+        rows = cur.fetchmany(chunksize)
+        if not rows:
+            break
+        rowids = [rowid for rowid,_ in rows]
+        wkbs = [bytes(wkb) for _,wkb in rows]
+        yield rowids, wkbs
+
+def _load(wkbs):
+    if SHAPELY2:
+        return shapely.from_wkb(wkbs)
+    else:
+        return [wkb_loads(wkb) for wkb in wkbs]
+
+
+def spatial_join(conn, left, leftcolumn, right, rightcolumn, predicate='intersects', chunksize=10000, into=None):
+    '''Finds all pairs of rows from two geom columns where predicate(leftgeom, rightgeom) is true.
+    The smaller side is loaded into an STRtree, and the larger side is streamed through it in chunks of chunksize rows.
+    Returns a list of (left rowid, right rowid) pairs, or if into is given, writes them
+    to a new table of that name with columns (left_id, right_id) and returns the number of pairs.'''
+    if predicate not in _CONVERSE:
+        raise Exception('Unsupported spatial join predicate: {}. Must be one of: {}'.format(predicate, ', '.join(sorted(_CONVERSE))))
+    chunksize = int(chunksize)
+
+    # build the tree over the smaller side, and stream the larger one
+    if _count(conn, left, leftcolumn) <= _count(conn, right, rightcolumn):
+        treeside,streamside = (left,leftcolumn),(right,rightcolumn)
+        swapped = False
+    else:
+        treeside,streamside = (right,rightcolumn),(left,leftcolumn)
+        swapped = True
+    # the streamed geoms are the first argument of the query predicate
+    querypred = predicate if swapped else _CONVERSE[predicate]
+
+    treeids = []
+    treegeoms = []
+    for rowids,wkbs in _read_chunks(conn, treeside[0], treeside[1], chunksize):
+        treeids.extend(rowids)
+        treegeoms.extend(_load(wkbs))
+    tree = STRtree(treegeoms)
+    if not SHAPELY2:
+        # shapely 1 queries return the candidate geometries themselves, not their positions
+        positions = dict([(id(geom), i) for i,geom in enumerate(treegeoms)])
+
+    if into:
+        conn.execute('create table {} (left_id integer, right_id integer)'.format(_quote(into)))
+        insert = 'insert into {} values (?, ?)'.format(_quote(into))
+        count = 0
+    else:
+        pairs = []
+
+    for rowids,wkbs in _read_chunks(conn, streamside[0], streamside[1], chunksize):
+        geoms = _load(wkbs)
+        if SHAPELY2:
+            streamidx,treeidx = tree.query(geoms, predicate=querypred)
+            matches = [(rowids[i], treeids[j]) for i,j in zip(streamidx.tolist(), treeidx.tolist())]
+        else:
+            matches = []
+            for rowid,geom in zip(rowids, geoms):
+                # not all predicates are available on prepared geometries
+                test = getattr(prep(geom), querypred, None) or getattr(geom, querypred)
+                for candidate in tree.query(geom):
+                    if test(candidate):
+                        matches.append((rowid, treeids[positions[id(candidate)]]))
+        if not swapped:
+            matches = [(treeid, rowid) for rowid,treeid in matches]
+
+        if into:
+            conn.executemany(insert, matches)
+            count += len(matches)
+        else:
+            pairs.extend(matches)
+
+    if into:
+        conn.commit()
+        return count
+    else:
+        return pairs
+
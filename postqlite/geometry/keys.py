@@ -0,0 +1,231 @@
+
+# space filling curve keys, for ordering rows so that spatially close rows are also close on disk
+# the curves are laid over an extent divided into a grid of 2**bits x 2**bits cells,
+# and the key is the position of a cell along the curve, ie a 2*bits integer.
+# also geohash and quadkey strings, which are curve keys over the lon,lat world extent
+
+import math
+
+
+def grid_cell(x, y, extent, bits):
+    '''The integer (col, row) of the grid cell containing x,y, clamped to the extent'''
+    xmin,ymin,xmax,ymax = extent
+    n = 1 << bits
+    w = xmax - xmin
+    h = ymax - ymin
+    col = int((x - xmin) / w * n) if w > 0 else 0
+    row = int((y - ymin) / h * n) if h > 0 else 0
+    col = min(max(col, 0), n-1)
+    row = min(max(row, 0), n-1)
+    return col, row
+
+
+def hilbert_key(col, row, bits):
+    '''Position of grid cell col,row along a hilbert curve,
+    see: https://en.wikipedia.org/wiki/Hilbert_curve#Applications_and_mapping_algorithms'''
+    n = 1 << bits
+    key = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if col & s else 0
+        ry = 1 if row & s else 0
+        key += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                col = n-1 - col
+                row = n-1 - row
+            col,row = row,col
+        s >>= 1
+    return key
+
+
+def zorder_key(col, row, bits):
+    '''Position of grid cell col,row along a z-order (morton) curve, ie the interleaved bits'''
+    key = 0
+    for i in range(bits):
+        key |= ((col >> i) & 1) << (2*i)
+        key |= ((row >> i) & 1) << (2*i + 1)
+    return key
+
+
+def _check_bits(bits):
+    # keys must fit in a signed 64-bit sqlite integer
+    bits = int(bits)
+    if not 1 <= bits <= 31:
+        raise Exception('Number of bits must be between 1 and 31, not {}'.format(bits))
+    return bits
+
+def bbox_key(bbox, extent, bits=16, curve='hilbert'):
+    '''Curve key of the centre of a bbox, or None if empty'''
+    bits = _check_bits(bits)
+    xmin,ymin,xmax,ymax = bbox
+    if math.isnan(xmin):
+        return None
+    col,row = grid_cell((xmin+xmax)/2.0, (ymin+ymax)/2.0, extent, bits)
+    if curve == 'hilbert':
+        return hilbert_key(col, row, bits)
+    elif curve == 'zorder':
+        return zorder_key(col, row, bits)
+    else:
+        raise Exception('Unknown curve: {}'.format(curve))
+
+
+# geohash
+# see: https://en.wikipedia.org/wiki/Geohash
+
+_GEOHASH_CHARS = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def _geohash_bits(precision):
+    # the longitude gets the extra bit when the number of bits is odd
+    nbits = 5 * precision
+    return (nbits + 1) // 2, nbits // 2
+
+def _geohash_cell(x, y, precision):
+    lonbits,latbits = _geohash_bits(precision)
+    col = int((x + 180) / 360.0 * (1 << lonbits))
+    row = int((y + 90) / 180.0 * (1 << latbits))
+    col = min(max(col, 0), (1 << lonbits) - 1)
+    row = min(max(row, 0), (1 << latbits) - 1)
+    return col, row
+
+def _geohash_from_cell(col, row, precision):
+    lonbits,latbits = _geohash_bits(precision)
+    # interleave the bits, starting with longitude
+    code = 0
+    for i in range(5 * precision):
+        if i % 2 == 0:
+            lonbits -= 1
+            bit = (col >> lonbits) & 1
+        else:
+            latbits -= 1
+            bit = (row >> latbits) & 1
+        code = (code << 1) | bit
+    return ''.join([_GEOHASH_CHARS[(code >> 5*i) & 31] for i in reversed(range(precision))])
+
+def geohash(x, y, precision=12):
+    '''Geohash of a lon,lat coordinate with precision number of characters'''
+    col,row = _geohash_cell(x, y, precision)
+    return _geohash_from_cell(col, row, precision)
+
+def bbox_geohash(bbox, precision=12):
+    '''Geohash of the smallest geohash cell containing the bbox, at most precision characters long,
+    empty string if it spans more than one top level cell, and None if empty'''
+    xmin,ymin,xmax,ymax = bbox
+    if math.isnan(xmin):
+        return None
+    return _common_prefix(geohash(xmin, ymin, precision), geohash(xmax, ymax, precision))
+
+
+# quadkey
+# see: https://docs.microsoft.com/en-us/bingmaps/articles/bing-maps-tile-system
+
+_MAX_LATITUDE = 85.05112878
+
+def _quadkey_tile(x, y, zoom):
+    # web mercator tile containing lon,lat
+    y = min(max(y, -_MAX_LATITUDE), _MAX_LATITUDE)
+    sinlat = math.sin(math.radians(y))
+    px = (x + 180) / 360.0
+    py = 0.5 - math.log((1 + sinlat) / (1 - sinlat)) / (4 * math.pi)
+    n = 1 << zoom
+    tx = min(max(int(px * n), 0), n-1)
+    ty = min(max(int(py * n), 0), n-1)
+    return tx, ty
+
+def _quadkey_from_tile(tx, ty, zoom):
+    digits = []
+    for i in reversed(range(zoom)):
+        digit = ((tx >> i) & 1) + 2 * ((ty >> i) & 1)
+        digits.append(str(digit))
+    return ''.join(digits)
+
+def quadkey(x, y, zoom):
+    '''Quadkey of the tile containing a lon,lat coordinate at a zoom level'''
+    tx,ty = _quadkey_tile(x, y, zoom)
+    return _quadkey_from_tile(tx, ty, zoom)
+
+def bbox_quadkey(bbox, zoom):
+    '''Quadkey of the smallest tile containing the bbox, at most zoom characters long,
+    empty string if it spans more than one top level tile, and None if empty'''
+    xmin,ymin,xmax,ymax = bbox
+    if math.isnan(xmin):
+        return None
+    return _common_prefix(quadkey(xmin, ymax, zoom), quadkey(xmax, ymin, zoom))
+
+
+# prefix ranges
+# all hashes within a cell start with the hash of that cell, and since the characters
+# are in ascending order, the hashes covering a bbox can be looked up as a few string ranges
+# with a regular index on a geohash or quadkey column, eg:
+#
+#     ranges = geohash_ranges((10.7, 59.9, 10.8, 60.0))
+#     where,params = prefix_where('hash', ranges)
+#     conn.execute('select * from t where ' + where, params)
+#
+# the ranges cover whole cells, so may include some rows just outside the bbox.
+# they only work for columns of point hashes: a bbox_geohash/bbox_quadkey of a larger geom
+# is the shorter hash of a cell containing it, which sorts before the ranges of the cells within it
+
+def _common_prefix(a, b):
+    i = 0
+    while i < len(a) and i < len(b) and a[i] == b[i]:
+        i += 1
+    return a[:i]
+
+def _next_prefix(prefix, chars):
+    # the smallest string greater than all strings starting with prefix, None if there is none
+    prefix = prefix.rstrip(chars[-1])
+    if not prefix:
+        return None
+    return prefix[:-1] + chars[chars.index(prefix[-1]) + 1]
+
+def _prefix_ranges(prefixes, chars):
+    # merges the prefixes into as few (low, high) ranges as possible, where high is exclusive or None
+    ranges = []
+    for prefix in sorted(set(prefixes)):
+        high = _next_prefix(prefix, chars)
+        if ranges and ranges[-1][1] == prefix:
+            ranges[-1] = (ranges[-1][0], high)
+        else:
+            ranges.append((prefix, high))
+    return ranges
+
+def _cell_ranges(bbox, maxcells, levels, cell, fromcell, chars):
+    # covering cells at the deepest level that needs no more than maxcells cells
+    xmin,ymin,xmax,ymax = bbox
+    best = None
+    for level in levels:
+        (col0,row0),(col1,row1) = cell(xmin, ymin, level), cell(xmax, ymax, level)
+        cols = range(min(col0,col1), max(col0,col1)+1)
+        rows = range(min(row0,row1), max(row0,row1)+1)
+        if best is not None and len(cols) * len(rows) > maxcells:
+            break
+        best = [fromcell(col, row, level) for col in cols for row in rows]
+    return _prefix_ranges(best, chars)
+
+def geohash_ranges(bbox, maxcells=16, maxprecision=12):
+    '''Geohash prefix ranges covering a lon,lat bbox, as a list of (low, high) strings where high is exclusive or None.
+    Only finds the hashes of points, not the shorter hashes of larger geoms.'''
+    return _cell_ranges(bbox, maxcells, range(1, maxprecision+1), _geohash_cell, _geohash_from_cell, _GEOHASH_CHARS)
+
+def quadkey_ranges(bbox, maxcells=16, maxzoom=23):
+    '''Quadkey prefix ranges covering a lon,lat bbox, as a list of (low, high) strings where high is exclusive or None.
+    Only finds the quadkeys of points, not the shorter quadkeys of larger geoms.'''
+    return _cell_ranges(bbox, maxcells, range(1, maxzoom+1), _quadkey_tile, _quadkey_from_tile, '0123')
+
+def prefix_where(column, ranges):
+    '''Sql where clause and params for looking up prefix ranges in a hash column.
+    The column must hold hashes of points, see geohash_ranges/quadkey_ranges.'''
+    conditions = []
+    params = []
+    for low,high in ranges:
+        if high is None:
+            conditions.append('{col} >= ?')
+            params.append(low)
+        else:
+            conditions.append('({col} >= ? and {col} < ?)')
+            params.extend([low, high])
+    col = '"{}"'.format(column.replace('"', '""'))
+    return '(' + ' or '.join(conditions).format(col=col) + ')', params
+
@@ -0,0 +1,115 @@
+
+# area, length, perimeter and centroid calculated directly from the parsed wkb coordinates without shapely
+# geometries are the (type, dims, coords) tuples returned by wkb.read_geometry()
+# follows the postgis semantics, ie length is only for linear and perimeter only for areal geometries
+
+import numpy as np
+
+
+def _ring_area_centroid(ring):
+    # signed shoelace area and centroid of a ring
+    # coords are shifted to the first vertex to avoid loss of precision with large coordinates
+    x0,y0 = ring[0, 0],ring[0, 1]
+    x = ring[:, 0] - x0
+    y = ring[:, 1] - y0
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area2 = float(cross.sum())
+    if area2 == 0:
+        return 0.0, None
+    cx = float(((x[:-1] + x[1:]) * cross).sum()) / (3 * area2) + x0
+    cy = float(((y[:-1] + y[1:]) * cross).sum()) / (3 * area2) + y0
+    return area2 / 2.0, (cx, cy)
+
+def _line_length_centroid(line):
+    # length and length weighted centroid of a linestring or ring
+    x = line[:, 0]
+    y = line[:, 1]
+    seglengths = np.hypot(np.diff(x), np.diff(y))
+    length = float(seglengths.sum())
+    if length == 0:
+        return 0.0, None
+    cx = float((seglengths * (x[:-1] + x[1:])).sum()) / (2 * length)
+    cy = float((seglengths * (y[:-1] + y[1:])).sum()) / (2 * length)
+    return length, (cx, cy)
+
+def _parts(geom, polys, lines, points):
+    # flattens into lists of polygon rings, linestrings and point arrays
+    typ,dims,coords = geom
+    if typ == 'Point':
+        points.append(coords.reshape((1, len(dims))))
+    elif typ == 'MultiPoint':
+        points.append(coords)
+    elif typ == 'LineString':
+        lines.append(coords)
+    elif typ == 'Polygon':
+        polys.append([ring for ring in coords if len(ring) >= 4])
+    else:
+        for member in coords:
+            _parts(member, polys, lines, points)
+    return polys, lines, points
+
+
+def area(geom):
+    polys,_,_ = _parts(geom, [], [], [])
+    total = 0.0
+    for rings in polys:
+        for i,ring in enumerate(rings):
+            ringarea = abs(_ring_area_centroid(ring)[0])
+            # the first ring is the exterior, the rest are holes
+            total += ringarea if i == 0 else -ringarea
+    return total
+
+def length(geom):
+    _,lines,_ = _parts(geom, [], [], [])
+    return float(sum([_line_length_centroid(line)[0] for line in lines if len(line) >= 2]))
+
+def perimeter(geom):
+    polys,_,_ = _parts(geom, [], [], [])
+    return float(sum([_line_length_centroid(ring)[0] for rings in polys for ring in rings]))
+
+def centroid(geom):
+    '''Returns the (x,y) centroid, or None if empty.
+    Like postgis, only the highest dimension parts contribute, ie lines are ignored if there are polygons,
+    and falls back to the lower dimensions if the higher ones are degenerate (zero area or length).'''
+    polys,lines,points = _parts(geom, [], [], [])
+
+    # area weighted
+    weights = []
+    centers = []
+    for rings in polys:
+        for i,ring in enumerate(rings):
+            ringarea,center = _ring_area_centroid(ring)
+            if center is not None:
+                weights.append(abs(ringarea) if i == 0 else -abs(ringarea))
+                centers.append(center)
+    if weights and sum(weights) != 0:
+        return _weighted_mean(weights, centers)
+
+    # length weighted, including the rings of degenerate polygons
+    weights = []
+    centers = []
+    for line in lines + [ring for rings in polys for ring in rings]:
+        if len(line) >= 2:
+            linelength,center = _line_length_centroid(line)
+            if center is not None:
+                weights.append(linelength)
+                centers.append(center)
+    if weights:
+        return _weighted_mean(weights, centers)
+
+    # mean of all points, including the vertices of degenerate lines and polygons
+    arrays = [arr[:, :2] for arr in points + lines + [ring for rings in polys for ring in rings] if len(arr)]
+    if not arrays:
+        return None
+    coords = np.concatenate(arrays)
+    coords = coords[~np.isnan(coords[:, 0])] # empty points are stored as nan
+    if not len(coords):
+        return None
+    return float(coords[:, 0].mean()), float(coords[:, 1].mean())
+
+def _weighted_mean(weights, centers):
+    weights = np.array(weights)
+    centers = np.array(centers)
+    total = weights.sum()
+    return float((centers[:, 0] * weights).sum() / total), float((centers[:, 1] * weights).sum() / total)
+
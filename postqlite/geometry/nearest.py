@@ -0,0 +1,148 @@
+
+# nearest neighbour and within distance searches, using the rtree spatial index if the column has one
+# sqlite3 in python has no way to define table-valued functions, so the sql funcs st_KNN
+# and st_DWithinRowids return the matching rowids as a json array, which can be expanded with json_each:
+#
+#     select t.*, st_Distance(t.geom, st_Point(1,2))
+#     from json_each(st_KNN('t', 'geom', st_Point(1,2), 10)) as nn, t
+#     where t.rowid = nn.value
+#     order by nn.key
+#
+# in joins, the index can also be used directly by comparing it to the expanded bbox of the other side,
+# leaving st_DWithin to only check the candidate pairs:
+#
+#     select a.rowid, b.rowid
+#     from a, idx_b_geom as i, b
+#     where i.xmax >= st_Xmin(a.geom) - 10 and i.xmin <= st_Xmax(a.geom) + 10
+#     and i.ymax >= st_Ymin(a.geom) - 10 and i.ymin <= st_Ymax(a.geom) + 10
+#     and b.rowid = i.id
+#     and st_DWithin(a.geom, b.geom, 10)
+
+import heapq
+import json
+import math
+
+from .geometry import Geometry, _bbox_distance, _expand_bbox
+from .index import _quote, _root_node, spatial_index_name, has_spatial_index, query_spatial_index
+
+
+def register_funcs(conn):
+    conn.create_function('st_KNN', 4, lambda table,column,wkb,k: json.dumps([rowid for rowid,_ in knn(conn, table, column, Geometry(wkb), k)]) if wkb != None else None )
+    conn.create_function('st_DWithinRowids', 4, lambda table,column,wkb,dist: json.dumps(dwithin(conn, table, column, Geometry(wkb), dist)) if wkb != None else None )
+
+
+def _as_geom(value):
+    # columns declared as geom are already converted to Geometry by the connection
+    return value if isinstance(value, Geometry) else Geometry(value)
+
+
+def knn(conn, table, column, geom, k):
+    '''Returns the rowids and distances of the k rows of a geom column nearest to geom,
+    as a list of (rowid, distance) sorted by distance.'''
+    k = int(k)
+    if k <= 0:
+        return []
+    if has_spatial_index(conn, table, column):
+        return _knn_index(conn, table, column, geom, k)
+    else:
+        return _knn_scan(conn, table, column, geom, k)
+
+
+def _knn_scan(conn, table, column, geom, k):
+    # no index, check all rows but only calculate the exact distance
+    # for those whose bbox is closer than the current kth nearest
+    bbox = geom.bbox()
+    heap = [] # max-heap of the k nearest so far, as (-distance, -rowid)
+    sql = 'select rowid, {col} from {table} where {col} is not null'.format(col=_quote(column), table=_quote(table))
+    for rowid,wkb in conn.execute(sql):
+        othergeom = _as_geom(wkb)
+        if len(heap) == k and _bbox_distance(bbox, othergeom.bbox()) > -heap[0][0]:
+            continue
+        dist = geom.distance(othergeom)
+        if math.isnan(dist):
+            # empty geoms have no distance
+            continue
+        item = (-dist, -rowid)
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return sorted([(-negrowid, -negdist) for negdist,negrowid in heap], key=lambda item: (item[1], item[0]))
+
+
+def _knn_index(conn, table, column, geom, k):
+    # incremental search of an expanding window around geom
+    # the bbox distance of each index entry is a lower bound of its exact distance,
+    # so exact distances are only calculated in order of bbox distance until they can no longer beat the kth nearest.
+    # the search is complete once the kth nearest is within the window, since all rows
+    # outside the window must be further away than that.
+    depth,cells = _root_node(conn, table, column)
+    if not cells:
+        return []
+    exmin = min([cell[1] for cell in cells])
+    exmax = max([cell[2] for cell in cells])
+    eymin = min([cell[3] for cell in cells])
+    eymax = max([cell[4] for cell in cells])
+    xmin,ymin,xmax,ymax = geom.bbox()
+    if math.isnan(xmin):
+        return []
+
+    # start with a window that would hold about k rows if they were evenly spread,
+    # with the number of rows roughly estimated from the depth of the tree (about 50 cells per node, 2/3 full)
+    estimate = len(cells) * 33 ** depth
+    w,h = exmax-exmin, eymax-eymin
+    radius = math.sqrt(w * h * k / float(estimate) / math.pi)
+
+    idxsql = '''select id, xmin, ymin, xmax, ymax from {}
+                where xmax >= ? and xmin <= ? and ymax >= ? and ymin <= ?'''.format(_quote(spatial_index_name(table, column)))
+    geomsql = 'select {} from {} where rowid = ?'.format(_quote(column), _quote(table))
+
+    bounds = {} # rowid -> bbox distance
+    exact = {} # rowid -> exact distance
+    while True:
+        window = xmin-radius, ymin-radius, xmax+radius, ymax+radius
+        for rowid,bxmin,bymin,bxmax,bymax in conn.execute(idxsql, (window[0], window[2], window[1], window[3])):
+            if rowid not in bounds:
+                bounds[rowid] = _bbox_distance((xmin,ymin,xmax,ymax), (bxmin,bymin,bxmax,bymax))
+
+        # refine in order of bbox distance
+        nearest = [] # max-heap of the k nearest so far, as (-distance, -rowid)
+        for bound,rowid in sorted([(bound,rowid) for rowid,bound in bounds.items()]):
+            if len(nearest) == k and bound > -nearest[0][0]:
+                break
+            if rowid not in exact:
+                (wkb,) = conn.execute(geomsql, (rowid,)).fetchone()
+                exact[rowid] = geom.distance(_as_geom(wkb))
+            if math.isnan(exact[rowid]):
+                # empty geoms have no distance
+                continue
+            item = (-exact[rowid], -rowid)
+            if len(nearest) < k:
+                heapq.heappush(nearest, item)
+            elif item > nearest[0]:
+                heapq.heapreplace(nearest, item)
+
+        covers = window[0] <= exmin and window[1] <= eymin and window[2] >= exmax and window[3] >= eymax
+        if covers or (len(nearest) == k and -nearest[0][0] <= radius):
+            break
+
+        # expand the window
+        radius = radius * 2 if radius > 0 else (max(w, h) or 1.0)
+
+    return sorted([(-negrowid, -negdist) for negdist,negrowid in nearest], key=lambda item: (item[1], item[0]))
+
+
+def dwithin(conn, table, column, geom, dist):
+    '''Returns the rowids of all rows of a geom column within dist of geom.
+    Candidates are found with the spatial index if the column has one.'''
+    bbox = _expand_bbox(geom.bbox(), dist)
+    if has_spatial_index(conn, table, column):
+        rowids = query_spatial_index(conn, table, column, bbox)
+        geomsql = 'select {} from {} where rowid = ?'.format(_quote(column), _quote(table))
+        candidates = ((rowid, conn.execute(geomsql, (rowid,)).fetchone()[0]) for rowid in rowids)
+    else:
+        sql = 'select rowid, {col} from {table} where {col} is not null'.format(col=_quote(column), table=_quote(table))
+        candidates = conn.execute(sql)
+    return [rowid for rowid,wkb in candidates
+            if geom.dwithin(_as_geom(wkb), dist)]
+
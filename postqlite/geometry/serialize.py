@@ -9,6 +9,7 @@ from .geometry import Geometry
 def create_geom(blob):
     # from sqlite3 wkb blob to geometry memoryview
     # py2: memview of buffer, py3: memview of bytes
+    # blobs with an embedded bbox header (see blob.py) are detected by Geometry
     wkb_mem = memoryview(blob)
     geom = Geometry(wkb_mem)
     return geom
@@ -0,0 +1,196 @@
+
+# reading and writing wkb directly, without going through shapely
+# wkb structure: https://www.gaia-gis.it/gaia-sins/BLOB-Geometry.html
+
+from struct import Struct, pack, unpack_from
+import sys
+
+import numpy as np
+
+
+PY2 = sys.version_info[0] == 2
+
+wkbtype_to_shptype = {1: 'Point',
+                      2: 'LineString',
+                      3: 'Polygon',
+                      4: 'MultiPoint',
+                      5: 'MultiLineString',
+                      6: 'MultiPolygon',
+                      7: 'GeometryCollection'}
+
+
+# all wkb is written as little endian (ndr)
+_POINT = Struct('<bIdd')
+_HEADER_COUNT = Struct('<bII') # byteorder, type, number of points/rings/parts
+_COUNT = Struct('<I')
+
+
+def _pack_coords(coords):
+    flat = [v for xy in coords for v in xy]
+    return pack('<{}d'.format(len(flat)), *flat)
+
+def write_point(x, y):
+    return _POINT.pack(1, 1, x, y)
+
+def write_linestring(coords):
+    coords = list(coords)
+    return _HEADER_COUNT.pack(1, 2, len(coords)) + _pack_coords(coords)
+
+def write_polygon(rings):
+    # first ring is the exterior, any remaining rings are holes
+    wkb = _HEADER_COUNT.pack(1, 3, len(rings))
+    for ring in rings:
+        ring = list(ring)
+        wkb += _COUNT.pack(len(ring)) + _pack_coords(ring)
+    return wkb
+
+def write_multipoint(coords):
+    coords = list(coords)
+    wkb = _HEADER_COUNT.pack(1, 4, len(coords))
+    wkb += b''.join(_POINT.pack(1, 1, x, y) for x,y in coords)
+    return wkb
+
+def write_envelope(xmin, ymin, xmax, ymax):
+    # polygon with the same ring order as shapely's box()
+    ring = [(xmax,ymin), (xmax,ymax), (xmin,ymax), (xmin,ymin), (xmax,ymin)]
+    return write_polygon([ring])
+
+def write_box2d(xmin, ymin, xmax, ymax):
+    # postgis box2d is represented as a multipoint of the lower left and upper right corners
+    return write_multipoint([(xmin,ymin), (xmax,ymax)])
+
+
+# reading
+
+def read_header(wkb, offset=0):
+    '''Reads the geometry header at offset, returns (byteorder, typ, dims, offset of the geometry body),
+    where dims is one of 'XY', 'XYZ', 'XYM' or 'XYZM'.
+    Handles both the ISO (eg 1003 for PolygonZ) and the EWKB (high bit flags) type codes.'''
+    (byteorder,) = unpack_from('B', wkb, offset)
+    byteorder = '>' if byteorder == 0 else '<'
+    (typ,) = unpack_from(byteorder+'I', wkb, offset+1)
+    offset += 5
+
+    # ewkb flags
+    hasz = bool(typ & 0x80000000)
+    hasm = bool(typ & 0x40000000)
+    if typ & 0x20000000:
+        # skip srid
+        offset += 4
+    typ &= 0x0FFFFFFF
+
+    # iso type codes
+    if typ >= 1000:
+        dimcode,typ = divmod(typ, 1000)
+        hasz = dimcode in (1,3)
+        hasm = dimcode in (2,3)
+
+    dims = 'XY' + ('Z' if hasz else '') + ('M' if hasm else '')
+    return byteorder, typ, dims, offset
+
+def _coords(wkb, byteorder, ndims, num, offset):
+    # zero-copy view of num coordinates starting at offset
+    arr = np.frombuffer(wkb, dtype=byteorder+'f8', count=num*ndims, offset=offset)
+    return arr.reshape((num, ndims))
+
+def _multipoint_coords(wkb, num, offset):
+    # multipoint members each have their own header, so the coords are evenly spaced
+    # with a 5 byte gap, which can be read as a single strided view if all headers are the same
+    if num == 0:
+        return None
+    byteorder,typ,dims,_ = read_header(wkb, offset)
+    ndims = len(dims)
+    stride = 5 + 8*ndims
+    headers = np.ndarray((num, 5), dtype='u1', buffer=wkb, offset=offset, strides=(stride, 1))
+    if typ != 1 or (headers != headers[0]).any():
+        return None
+    coords = np.ndarray((num, ndims), dtype=byteorder+'f8', buffer=wkb, offset=offset+5, strides=(stride, 8))
+    return coords, offset + num*stride
+
+def read_geometry(wkb, offset=0):
+    '''Parses wkb into a nested (type, dims, coords) tuple without copying any coordinates,
+    where coords is a numpy array view over the wkb of shape (ndims,) for Point
+    and (n,ndims) for LineString and MultiPoint, a list of ring arrays for Polygon,
+    and a list of member geometry tuples for the other multi types and GeometryCollection.
+    Returns the parsed geometry and the offset where it ended.'''
+    if PY2:
+        # py2: numpy doesnt accept memoryviews
+        wkb = wkb.tobytes() if isinstance(wkb, memoryview) else wkb
+    byteorder,typ,dims,offset = read_header(wkb, offset)
+    typname = wkbtype_to_shptype[typ]
+    ndims = len(dims)
+
+    if typ == 1:
+        coords = _coords(wkb, byteorder, ndims, 1, offset)[0]
+        offset += 8*ndims
+
+    elif typ == 2:
+        (num,) = unpack_from(byteorder+'I', wkb, offset)
+        offset += 4
+        coords = _coords(wkb, byteorder, ndims, num, offset)
+        offset += 8*ndims*num
+
+    elif typ == 3:
+        (num,) = unpack_from(byteorder+'I', wkb, offset)
+        offset += 4
+        coords = []
+        for _ in range(num):
+            (pnum,) = unpack_from(byteorder+'I', wkb, offset)
+            offset += 4
+            coords.append(_coords(wkb, byteorder, ndims, pnum, offset))
+            offset += 8*ndims*pnum
+
+    else:
+        (num,) = unpack_from(byteorder+'I', wkb, offset)
+        offset += 4
+        fast = _multipoint_coords(wkb, num, offset) if typ == 4 else None
+        if fast:
+            coords,offset = fast
+        else:
+            coords = []
+            for _ in range(num):
+                member,offset = read_geometry(wkb, offset)
+                coords.append(member)
+            if typ == 4:
+                # multipoint coords are always given as a single array
+                coords = np.array([member[2] for member in coords]).reshape((num, ndims))
+
+    return (typname, dims, coords), offset
+
+def _bbox_arrays(geom, arrays):
+    # collect the coordinate arrays needed to calculate the bbox
+    typ,dims,coords = geom
+    if typ == 'Point':
+        arrays.append(coords.reshape((1, len(dims))))
+    elif typ in ('LineString','MultiPoint'):
+        arrays.append(coords)
+    elif typ == 'Polygon':
+        # only the exterior, holes are always inside
+        if coords:
+            arrays.append(coords[0])
+    else:
+        for member in coords:
+            _bbox_arrays(member, arrays)
+    return arrays
+
+def read_bbox(wkb):
+    '''Calculates the (xmin,ymin,xmax,ymax) bbox of a wkb geometry, nan if empty'''
+    byteorder,typ,_,offset = read_header(wkb)
+    if typ == 1:
+        # points are common enough to skip the parsing
+        x,y = unpack_from(byteorder+'dd', wkb, offset)
+        return x,y,x,y
+
+    geom,_ = read_geometry(wkb)
+    arrays = [arr for arr in _bbox_arrays(geom, []) if len(arr)]
+    if not arrays:
+        nan = float('nan')
+        return nan,nan,nan,nan
+    elif len(arrays) == 1:
+        coords = arrays[0]
+    else:
+        coords = np.concatenate([arr[:, :2] for arr in arrays])
+    # reducing each column separately is much faster than along axis 0
+    xs,ys = coords[:, 0],coords[:, 1]
+    return float(xs.min()),float(ys.min()),float(xs.max()),float(ys.max())
+
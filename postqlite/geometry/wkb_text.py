@@ -0,0 +1,126 @@
+
+# writing wkb as wkt or geojson text, directly from the parsed wkb coordinates without shapely
+# geometries are the (type, dims, coords) tuples returned by wkb.read_geometry()
+
+import json
+
+import numpy as np
+
+
+# number formatting
+
+def _number_formatter(precision=None):
+    # None means full precision (shortest repr), otherwise max number of decimals
+    # trailing zeros are trimmed in both cases, ie 1.0 -> 1
+    if precision is None:
+        def fmt(v):
+            txt = repr(v)
+            if txt.endswith('.0'):
+                txt = txt[:-2]
+            return txt
+    else:
+        template = '%.{}f'.format(int(precision))
+        def fmt(v):
+            txt = template % v
+            if '.' in txt:
+                txt = txt.rstrip('0').rstrip('.')
+            if txt == '-0':
+                txt = '0'
+            return txt
+    return fmt
+
+
+# wkt
+
+def _wkt_coords(arr, fmt):
+    return ', '.join([' '.join([fmt(v) for v in coord])
+                      for coord in arr.tolist()])
+
+def _wkt_body(geom, fmt):
+    typ,dims,coords = geom
+    if typ == 'Point':
+        if np.isnan(coords[0]):
+            return 'EMPTY'
+        return '({})'.format(' '.join([fmt(v) for v in coords.tolist()]))
+    elif typ == 'LineString':
+        if not len(coords):
+            return 'EMPTY'
+        return '({})'.format(_wkt_coords(coords, fmt))
+    elif typ == 'Polygon':
+        if not coords:
+            return 'EMPTY'
+        return '({})'.format(', '.join(['({})'.format(_wkt_coords(ring, fmt)) for ring in coords]))
+    elif typ == 'MultiPoint':
+        if not len(coords):
+            return 'EMPTY'
+        return '({})'.format(', '.join(['({})'.format(' '.join([fmt(v) for v in coord]))
+                                        for coord in coords.tolist()]))
+    elif typ == 'GeometryCollection':
+        if not coords:
+            return 'EMPTY'
+        return '({})'.format(', '.join([_wkt(member, fmt) for member in coords]))
+    else:
+        # other multi types
+        if not coords:
+            return 'EMPTY'
+        return '({})'.format(', '.join([_wkt_body(member, fmt) for member in coords]))
+
+def _wkt(geom, fmt):
+    typ,dims,coords = geom
+    name = typ.upper()
+    if dims != 'XY':
+        name += ' ' + dims[2:]
+    return '{} {}'.format(name, _wkt_body(geom, fmt))
+
+def write_wkt(geom, precision=None):
+    '''Formats a parsed wkb geometry as wkt, eg POINT Z (1 2 3)'''
+    fmt = _number_formatter(precision)
+    return _wkt(geom, fmt)
+
+
+# geojson
+
+def _geojson_coords(geom, precision):
+    typ,dims,coords = geom
+
+    def tolist(arr):
+        # geojson allows x,y,z but not m
+        if dims == 'XYM':
+            arr = arr[..., :2]
+        elif dims == 'XYZM':
+            arr = arr[..., :3]
+        if precision is not None:
+            # adding 0.0 turns any rounded -0.0 into 0.0
+            arr = np.round(arr, int(precision)) + 0.0
+        return arr.tolist()
+
+    if typ == 'Point':
+        # empty points are stored as nan
+        return [] if np.isnan(coords[0]) else tolist(coords)
+    elif typ in ('LineString','MultiPoint'):
+        return tolist(coords)
+    elif typ == 'Polygon':
+        return [tolist(ring) for ring in coords]
+    else:
+        return [_geojson_coords(member, precision) for member in coords]
+
+def geojson_dict(geom, precision=None):
+    '''Converts a parsed wkb geometry to a geojson dict, with coordinates rounded to precision if given'''
+    typ,dims,coords = geom
+    if typ == 'GeometryCollection':
+        return {'type': typ,
+                'geometries': [geojson_dict(member, precision) for member in coords]}
+    else:
+        return {'type': typ,
+                'coordinates': _geojson_coords(geom, precision)}
+
+def write_geojson(geom, precision=None):
+    '''Formats a parsed wkb geometry as a geojson string'''
+    typ,dims,coords = geom
+    if typ == 'GeometryCollection':
+        members = ', '.join([write_geojson(member, precision) for member in coords])
+        return '{{"type": "GeometryCollection", "geometries": [{}]}}'.format(members)
+    else:
+        coordstr = json.dumps(_geojson_coords(geom, precision))
+        return '{{"type": "{}", "coordinates": {}}}'.format(typ, coordstr)
+
@@ -4,7 +4,10 @@ import sqlite3
 #from . import ops
 #from . import stats
 from .geometry import geometry
+from .geometry import nearest
+from .geometry import join
 from .raster import raster
+from .raster import zonal
 
 
 sqlite3.enable_callback_tracebacks(True)
@@ -23,7 +26,10 @@ def connect(path, *args, **kwargs):
     #ops.register_funcs(self.db)
     geometry.register_funcs(conn)
     geometry.register_aggs(conn)
+    nearest.register_funcs(conn)
+    join.register_funcs(conn)
     raster.register_funcs(conn)
     raster.register_aggs(conn)
+    zonal.register_funcs(conn)
 
     return conn
@@ -3,5 +3,10 @@ from . import load
 from . import fileformats
 from . import serialize
 from . import data
+from . import stats
+from . import expression
+from . import zonal
+
+from .zonal import zonal_stats
 
 
@@ -0,0 +1,510 @@
+
+# mapalgebra expressions, parsed once and compiled into a plan of numpy operations
+# expressions are sql-like, with raster references in brackets, eg:
+#
+#     [rast] * 2 + 1
+#     case when [rast1] between 0 and 10 and [rast2] <> 0 then [rast1] / [rast2] else null end
+#
+# supports arithmetic (+ - * / % and ^ or ** for power), comparisons (= == != <> < <= > >=), between, and/or/not,
+# case when ... then ... else ... end (also case x when ...), null, true/false,
+# and the funcs in _FUNCS. Null evaluates to the null value given when evaluating.
+# compiled expressions are cached by their text, so the same expression is only parsed once.
+#
+# when evaluating into an output array, large rasters are evaluated with numexpr if it is installed,
+# which avoids full size temporary arrays and uses all cores, or else in blocks of rows small enough
+# to stay in the cpu cache, spread over a pool of threads (numpy releases the gil while computing).
+# either way the peak memory is the inputs and the output plus a few blocks.
+
+import re
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+_TOKEN = re.compile(r'''\s*(?:
+    (?P<number>(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)
+    | \[(?P<ref>[a-z_][a-z0-9_]*)(?:\.val)?\]
+    | (?P<name>[a-z_][a-z0-9_]*)
+    | (?P<op><>|!=|<=|>=|==|\*\*|[-+*/%^(),<>=])
+    )''', re.VERBOSE)
+
+_KEYWORDS = ('and', 'or', 'not', 'between', 'case', 'when', 'then', 'else', 'end', 'null', 'true', 'false')
+
+_ARITHMETIC = {'+': np.add,
+               '-': np.subtract,
+               '*': np.multiply,
+               '/': np.true_divide,
+               '%': np.mod,
+               '^': np.power,
+               '**': np.power}
+
+_COMPARISONS = {'=': np.equal,
+                '==': np.equal,
+                '!=': np.not_equal,
+                '<>': np.not_equal,
+                '<': np.less,
+                '<=': np.less_equal,
+                '>': np.greater,
+                '>=': np.greater_equal}
+
+# func name: (numpy func, min args, max args or None if any number)
+_FUNCS = {'abs': (np.abs, 1, 1),
+          'sqrt': (np.sqrt, 1, 1),
+          'exp': (np.exp, 1, 1),
+          'ln': (np.log, 1, 1),
+          'log': (np.log10, 1, 1),
+          'floor': (np.floor, 1, 1),
+          'ceil': (np.ceil, 1, 1),
+          'ceiling': (np.ceil, 1, 1),
+          'round': (np.round, 1, 1),
+          'sin': (np.sin, 1, 1),
+          'cos': (np.cos, 1, 1),
+          'tan': (np.tan, 1, 1),
+          'power': (np.power, 2, 2),
+          'pow': (np.power, 2, 2),
+          'max': (np.maximum, 2, None),
+          'min': (np.minimum, 2, None),
+          'greatest': (np.maximum, 2, None),
+          'least': (np.minimum, 2, None)}
+
+
+def _tokenize(text):
+    tokens = []
+    text = text.lower()
+    pos = 0
+    end = len(text.rstrip())
+    while pos < end:
+        match = _TOKEN.match(text, pos)
+        if not match:
+            raise Exception('Invalid mapalgebra expression at position {}: {}'.format(pos, text))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'name' and value in _KEYWORDS:
+            kind = 'keyword'
+        tokens.append((kind, value))
+        pos = match.end()
+    tokens.append(('end', None))
+    return tokens
+
+
+class _Parser(object):
+    # recursive descent parser, returns a tree of nested tuples:
+    # ('num', value), ('ref', name), ('null',), ('neg', a), ('arith', op, a, b), ('cmp', op, a, b),
+    # ('and', a, b), ('or', a, b), ('not', a), ('between', a, low, high), ('func', name, args),
+    # ('case', [(cond, value), ...], default)
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self, kind=None, value=None):
+        tokkind,tokvalue = self.tokens[self.pos]
+        if kind is not None and tokkind != kind:
+            return False
+        if value is not None and tokvalue != value:
+            return False
+        return True
+
+    def accept(self, kind, value=None):
+        if self.peek(kind, value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, value=None):
+        if not self.accept(kind, value):
+            found = self.tokens[self.pos][1]
+            raise Exception('Invalid mapalgebra expression, expected {} but found {}: {}'.format(value or kind, found, self.text))
+        return self.tokens[self.pos-1][1]
+
+    def parse(self):
+        tree = self.parse_or()
+        self.expect('end')
+        return tree
+
+    def parse_or(self):
+        tree = self.parse_and()
+        while self.accept('keyword', 'or'):
+            tree = ('or', tree, self.parse_and())
+        return tree
+
+    def parse_and(self):
+        tree = self.parse_not()
+        while self.accept('keyword', 'and'):
+            tree = ('and', tree, self.parse_not())
+        return tree
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            return ('not', self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        tree = self.parse_additive()
+        if self.peek('op') and self.tokens[self.pos][1] in _COMPARISONS:
+            op = self.expect('op')
+            return ('cmp', op, tree, self.parse_additive())
+        negate = self.accept('keyword', 'not')
+        if self.accept('keyword', 'between'):
+            # the and here is part of the between clause, so bounds are parsed below the and level
+            low = self.parse_additive()
+            self.expect('keyword', 'and')
+            high = self.parse_additive()
+            tree = ('between', tree, low, high)
+            return ('not', tree) if negate else tree
+        if negate:
+            self.expect('keyword', 'between')
+        return tree
+
+    def parse_additive(self):
+        tree = self.parse_term()
+        while self.peek('op', '+') or self.peek('op', '-'):
+            op = self.expect('op')
+            tree = ('arith', op, tree, self.parse_term())
+        return tree
+
+    def parse_term(self):
+        tree = self.parse_unary()
+        while self.peek('op', '*') or self.peek('op', '/') or self.peek('op', '%'):
+            op = self.expect('op')
+            tree = ('arith', op, tree, self.parse_unary())
+        return tree
+
+    def parse_unary(self):
+        if self.accept('op', '-'):
+            return ('neg', self.parse_unary())
+        if self.accept('op', '+'):
+            return self.parse_unary()
+        return self.parse_power()
+
+    def parse_power(self):
+        tree = self.parse_primary()
+        if self.accept('op', '^') or self.accept('op', '**'):
+            # right associative, and binds tighter than unary minus on the left
+            return ('arith', '^', tree, self.parse_unary())
+        return tree
+
+    def parse_primary(self):
+        kind,value = self.tokens[self.pos]
+        if self.accept('number'):
+            return ('num', float(value) if '.' in value or 'e' in value else int(value))
+        elif self.accept('ref'):
+            return ('ref', value)
+        elif self.accept('keyword', 'null'):
+            return ('null',)
+        elif self.accept('keyword', 'true'):
+            return ('num', True)
+        elif self.accept('keyword', 'false'):
+            return ('num', False)
+        elif self.accept('keyword', 'case'):
+            return self.parse_case()
+        elif self.accept('name'):
+            return self.parse_func(value)
+        elif self.accept('op', '('):
+            tree = self.parse_or()
+            self.expect('op', ')')
+            return tree
+        raise Exception('Invalid mapalgebra expression, unexpected {}: {}'.format(value or 'end', self.text))
+
+    def parse_func(self, name):
+        if name not in _FUNCS:
+            raise Exception('Unknown mapalgebra function: {}'.format(name))
+        func,minargs,maxargs = _FUNCS[name]
+        self.expect('op', '(')
+        args = [self.parse_or()]
+        while self.accept('op', ','):
+            args.append(self.parse_or())
+        self.expect('op', ')')
+        if len(args) < minargs or (maxargs is not None and len(args) > maxargs):
+            raise Exception('Wrong number of arguments for mapalgebra function {}: {}'.format(name, len(args)))
+        return ('func', name, args)
+
+    def parse_case(self):
+        # simple case compares an operand to each when value
+        operand = None
+        if not self.peek('keyword', 'when'):
+            operand = self.parse_or()
+        whens = []
+        while self.accept('keyword', 'when'):
+            cond = self.parse_or()
+            if operand is not None:
+                cond = ('cmp', '=', operand, cond)
+            self.expect('keyword', 'then')
+            whens.append((cond, self.parse_or()))
+        if not whens:
+            raise Exception('Invalid mapalgebra expression, case without when: {}'.format(self.text))
+        default = self.parse_or() if self.accept('keyword', 'else') else ('null',)
+        self.expect('keyword', 'end')
+        return ('case', whens, default)
+
+
+def _refs(tree):
+    # names of all raster references in a node, or in a list or pair of nodes
+    if isinstance(tree, tuple) and tree and isinstance(tree[0], str):
+        if tree[0] == 'ref':
+            return set([tree[1]])
+        items = tree[1:]
+    else:
+        items = tree
+    refs = set()
+    for item in items:
+        if isinstance(item, (tuple, list)):
+            refs |= _refs(item)
+    return refs
+
+
+def _compile(tree):
+    # turns the tree into nested funcs of (env, null), so the tree is only walked once
+    kind = tree[0]
+    if kind == 'num':
+        value = tree[1]
+        return lambda env, null: value
+    elif kind == 'ref':
+        name = tree[1]
+        return lambda env, null: env[name]
+    elif kind == 'null':
+        return lambda env, null: null
+    elif kind == 'neg':
+        a = _compile(tree[1])
+        return lambda env, null: np.negative(a(env, null))
+    elif kind == 'not':
+        a = _compile(tree[1])
+        return lambda env, null: np.logical_not(a(env, null))
+    elif kind in ('arith', 'cmp'):
+        func = _ARITHMETIC[tree[1]] if kind == 'arith' else _COMPARISONS[tree[1]]
+        a,b = _compile(tree[2]), _compile(tree[3])
+        return lambda env, null: func(a(env, null), b(env, null))
+    elif kind == 'and':
+        a,b = _compile(tree[1]), _compile(tree[2])
+        return lambda env, null: np.logical_and(a(env, null), b(env, null))
+    elif kind == 'or':
+        a,b = _compile(tree[1]), _compile(tree[2])
+        return lambda env, null: np.logical_or(a(env, null), b(env, null))
+    elif kind == 'between':
+        a,low,high = _compile(tree[1]), _compile(tree[2]), _compile(tree[3])
+        def between(env, null):
+            value = a(env, null)
+            return np.logical_and(np.greater_equal(value, low(env, null)), np.less_equal(value, high(env, null)))
+        return between
+    elif kind == 'func':
+        func = _FUNCS[tree[1]][0]
+        args = [_compile(arg) for arg in tree[2]]
+        if len(args) == 1:
+            a = args[0]
+            return lambda env, null: func(a(env, null))
+        def call(env, null):
+            # variadic funcs like max and min are applied pairwise
+            result = args[0](env, null)
+            for arg in args[1:]:
+                result = func(result, arg(env, null))
+            return result
+        return call
+    elif kind == 'case':
+        conds = [_compile(cond) for cond,_ in tree[1]]
+        values = [_compile(value) for _,value in tree[1]]
+        default = _compile(tree[2])
+        def case(env, null):
+            # np.select picks the value of the first true condition for each pixel, like sql
+            condlist = [np.asarray(cond(env, null), dtype=bool) for cond in conds]
+            choicelist = [value(env, null) for value in values]
+            return np.select(condlist, choicelist, default(env, null))
+        return case
+    else:
+        raise Exception('Unknown expression node: {}'.format(kind))
+
+
+# numexpr
+
+# numexpr only supports some of the numpy dtypes
+_NUMEXPR_DTYPES = ('bool', 'int32', 'int64', 'float32', 'float64')
+
+_NUMEXPR_FUNCS = {'abs': 'abs',
+                  'sqrt': 'sqrt',
+                  'exp': 'exp',
+                  'ln': 'log',
+                  'log': 'log10',
+                  'sin': 'sin',
+                  'cos': 'cos',
+                  'tan': 'tan'}
+
+# nodes that always give booleans
+_BOOLEAN_NODES = ('cmp', 'and', 'or', 'not', 'between')
+
+def _numexpr_condition(tree):
+    # numexpr only has bitwise &, | and ~, and where() needs a boolean condition,
+    # so numbers are compared to zero first, like numpy's logical funcs and np.select do
+    source = _numexpr_source(tree)
+    if source is None:
+        return None
+    if tree[0] in _BOOLEAN_NODES:
+        return source
+    return '({} != 0)'.format(source)
+
+def _numexpr_source(tree):
+    # the tree as a numexpr expression string, or None if it uses anything numexpr does not support
+    # raster references are prefixed with r_ and null is passed as null_
+    kind = tree[0]
+    if kind == 'num':
+        if isinstance(tree[1], bool):
+            # numexpr folds true/false into plain python bools that & and | reject,
+            # so leave these to the blocked numpy path
+            return None
+        return repr(tree[1])
+    elif kind == 'ref':
+        return 'r_' + tree[1]
+    elif kind == 'null':
+        return 'null_'
+    elif kind == 'neg':
+        a = _numexpr_source(tree[1])
+        if a is None:
+            return None
+        return '(-{})'.format(a)
+    elif kind == 'not':
+        a = _numexpr_condition(tree[1])
+        if a is None:
+            return None
+        return '(~{})'.format(a)
+    elif kind in ('and', 'or'):
+        a,b = _numexpr_condition(tree[1]), _numexpr_condition(tree[2])
+        if a is None or b is None:
+            return None
+        return '({} {} {})'.format(a, '&' if kind == 'and' else '|', b)
+    elif kind in ('arith', 'cmp'):
+        op,a,b = tree[1:]
+        op = {'^': '**', '=': '==', '<>': '!='}.get(op, op)
+        a,b = _numexpr_source(a), _numexpr_source(b)
+        if a is None or b is None:
+            return None
+        return '({} {} {})'.format(a, op, b)
+    elif kind == 'between':
+        a,low,high = [_numexpr_source(sub) for sub in tree[1:]]
+        if a is None or low is None or high is None:
+            return None
+        return '(({a} >= {low}) & ({a} <= {high}))'.format(a=a, low=low, high=high)
+    elif kind == 'func':
+        name,args = tree[1:]
+        args = [_numexpr_source(arg) for arg in args]
+        if None in args:
+            return None
+        if name in ('power', 'pow'):
+            return '({} ** {})'.format(*args)
+        if name not in _NUMEXPR_FUNCS:
+            return None
+        return '{}({})'.format(_NUMEXPR_FUNCS[name], args[0])
+    elif kind == 'case':
+        # nested wheres, from the last when to the first
+        source = _numexpr_source(tree[2])
+        for cond,value in reversed(tree[1]):
+            cond,value = _numexpr_condition(cond), _numexpr_source(value)
+            if source is None or cond is None or value is None:
+                return None
+            source = 'where({}, {}, {})'.format(cond, value, source)
+        return source
+
+
+# blocked evaluation
+
+# number of pixels in each block, so that a few float64 blocks fit in the cpu cache
+BLOCK_PIXELS = 1 << 15
+USE_NUMEXPR = numexpr is not None
+THREADS = cpu_count()
+_pool = None
+
+def _thread_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(THREADS)
+    return _pool
+
+def _block_slices(height, width):
+    rows = max(1, BLOCK_PIXELS // max(1, width))
+    return [slice(start, min(start + rows, height)) for start in range(0, height, rows)]
+
+
+class Expression(object):
+    '''A mapalgebra expression compiled into a plan of numpy operations'''
+    def __init__(self, text):
+        self.text = text
+        self.tree = _Parser(text).parse()
+        self.names = sorted(_refs(self.tree))
+        self._plan = _compile(self.tree)
+        self._numexpr = _numexpr_source(self.tree) if numexpr is not None else None
+
+    def __repr__(self):
+        return '<Expression: {}>'.format(self.text)
+
+    def evaluate(self, env, null=0, out=None):
+        '''Evaluates the expression for a dict of raster reference names to arrays,
+        returning an array or scalar. If out is given, the result is cast and written to that array,
+        evaluating large arrays with numexpr or in blocks of rows, and out is returned.'''
+        for name in self.names:
+            if name not in env:
+                raise Exception('Unknown raster reference in mapalgebra expression: [{}]'.format(name))
+
+        if out is None or out.ndim == 0 or out.size <= BLOCK_PIXELS or not self.names:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = self._plan(env, null)
+            if out is None:
+                return result
+            out[...] = result
+            return out
+
+        if USE_NUMEXPR and self._numexpr is not None and self._numexpr_supports(env):
+            local = dict([('r_' + name, env[name]) for name in self.names])
+            local['null_'] = null
+            numexpr.evaluate(self._numexpr, local_dict=local, global_dict={}, out=out, casting='unsafe')
+            return out
+
+        self._evaluate_blocks(env, null, out)
+        return out
+
+    def _numexpr_supports(self, env):
+        for name in self.names:
+            value = env[name]
+            if isinstance(value, np.ndarray) and value.dtype.name not in _NUMEXPR_DTYPES:
+                return False
+        return True
+
+    def _evaluate_blocks(self, env, null, out):
+        # each block only needs temporary arrays the size of the block
+        height = out.shape[0]
+        width = out.size // height
+        def evaluate_block(rows):
+            blockenv = {}
+            for name in self.names:
+                value = env[name]
+                if isinstance(value, np.ndarray) and value.ndim and value.shape[0] == height:
+                    value = value[rows]
+                blockenv[name] = value
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out[rows] = self._plan(blockenv, null)
+        blocks = _block_slices(height, width)
+        if THREADS > 1 and len(blocks) > 1:
+            _thread_pool().map(evaluate_block, blocks)
+        else:
+            for rows in blocks:
+                evaluate_block(rows)
+
+
+# lru cache of compiled expressions, keyed by expression text
+CACHE_SIZE = 256
+_cache = OrderedDict()
+
+def compile_expression(text):
+    '''Returns the compiled Expression for the text, only parsing it the first time'''
+    expr = _cache.pop(text, None)
+    if expr is None:
+        expr = Expression(text)
+        if len(_cache) >= CACHE_SIZE:
+            _cache.popitem(last=False)
+    _cache[text] = expr
+    return expr
+
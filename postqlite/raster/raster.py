@@ -5,15 +5,19 @@ import numpy as np
 import numpy.ma as ma
 import math
 import json
-from struct import unpack_from, pack_into, pack, calcsize
+from struct import unpack_from, pack_into, pack, calcsize, Struct
 import sys
 
 from affine import Affine
-from shapely.geometry import Point, MultiPoint, Polygon
+from shapely.geometry import Point
 from PIL import Image
 
 from .load import file_reader
 from ..geometry.geometry import Geometry
+from ..geometry.wkb import write_polygon, write_box2d
+from .rasterize import geometry_mask
+from .stats import RunningStats
+from .expression import compile_expression
 
 from wkb_raster import write_wkb_raster
 
@@ -29,6 +33,66 @@ from wkb_raster import write_wkb_raster
 
 PY2 = sys.version_info[0] == 2
 
+# struct format, numpy dtype and byte size of each wkb raster pixel type
+PIXTYPE_FMTS = ['?', 'B', 'B', 'b', 'B', 'h',
+                'H', 'i', 'I', 'f', 'd']
+PIXTYPE_DTYPES = ['b1', 'u1', 'u1', 'i1', 'u1', 'i2',
+                  'u2', 'i4', 'u4', 'f4', 'f8']
+PIXTYPE_SIZES = [1, 1, 1, 1, 1, 2, 2, 4, 4, 4, 8]
+
+# raster header fields after the endian byte, their struct formats, and the precompiled structs
+# for each endian byte value (0 is big endian and 1 is little endian)
+HEADER_FIELDS = ('version', 'numbands', 'scaleX', 'scaleY', 'ipX', 'ipY',
+                 'skewX', 'skewY', 'srid', 'width', 'height')
+HEADER_FMTS = ('H', 'H', 'd', 'd', 'd', 'd', 'd', 'd', 'I', 'H', 'H')
+_ENDIAN_STRUCT = Struct('<b')
+_HEADER_STRUCTS = {}
+_FIELD_STRUCTS = {}
+for _endianbyte,_endian in ((0,'>'), (1,'<')):
+    _HEADER_STRUCTS[_endianbyte] = Struct(_endian + 'x' + ''.join(HEADER_FMTS))
+    _FIELD_STRUCTS[_endianbyte] = {}
+    _offset = 1
+    for _field,_fmt in zip(HEADER_FIELDS, HEADER_FMTS):
+        _FIELD_STRUCTS[_endianbyte][_field] = (_offset, Struct(_endian + _fmt))
+        _offset += calcsize(_fmt)
+
+
+def read_header_field(wkb, field):
+    '''Reads a single raster header field directly from the wkb, without parsing the rest of the header'''
+    (endianbyte,) = _ENDIAN_STRUCT.unpack_from(wkb)
+    offset,struct = _FIELD_STRUCTS[endianbyte][field]
+    return struct.unpack_from(wkb, offset)[0]
+
+
+class RasterHeader(object):
+    '''The raster header, decoded with a single struct unpack.
+    Fields can be accessed as attributes or as dict items.'''
+    __slots__ = ('endian',) + HEADER_FIELDS
+
+    def __init__(self, wkb=None):
+        if wkb is None:
+            return
+        (endianbyte,) = _ENDIAN_STRUCT.unpack_from(wkb)
+        self.endian = '>' if endianbyte == 0 else '<'
+        (self.version, self.numbands, self.scaleX, self.scaleY, self.ipX, self.ipY,
+         self.skewX, self.skewY, self.srid, self.width, self.height) = _HEADER_STRUCTS[endianbyte].unpack_from(wkb)
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def copy(self):
+        header = RasterHeader()
+        for field in self.__slots__:
+            setattr(header, field, getattr(self, field))
+        return header
+
+
 def register_funcs(conn):
     # see: https://postgis.net/docs/reference.html
 
@@ -38,15 +102,16 @@ def register_funcs(conn):
     conn.create_function('rt_Band', 2, lambda wkb,i: Raster(wkb).band(i).dump_wkb() ) 
 
     # metadata
-    conn.create_function('rt_Width', 1, lambda wkb: Raster(wkb).width if wkb else None)
-    conn.create_function('rt_Height', 1, lambda wkb: Raster(wkb).height if wkb else None)
-    conn.create_function('rt_ScaleX', 1, lambda wkb: Raster(wkb).scaleX if wkb else None)
-    conn.create_function('rt_ScaleY', 1, lambda wkb: Raster(wkb).scaleY if wkb else None)
-    conn.create_function('rt_SkewX', 1, lambda wkb: Raster(wkb).skewX if wkb else None)
-    conn.create_function('rt_SkewY', 1, lambda wkb: Raster(wkb).skewY if wkb else None)
-    conn.create_function('rt_UpperLeftX', 1, lambda wkb: Raster(wkb).upperLeftX if wkb else None)
-    conn.create_function('rt_UpperLeftY', 1, lambda wkb: Raster(wkb).upperLeftY if wkb else None)
-    conn.create_function('rt_NumBands', 1, lambda wkb: Raster(wkb).numbands if wkb else None)
+    # single fields are read straight from the wkb bytes, without creating a raster
+    conn.create_function('rt_Width', 1, lambda wkb: read_header_field(wkb, 'width') if wkb else None)
+    conn.create_function('rt_Height', 1, lambda wkb: read_header_field(wkb, 'height') if wkb else None)
+    conn.create_function('rt_ScaleX', 1, lambda wkb: read_header_field(wkb, 'scaleX') if wkb else None)
+    conn.create_function('rt_ScaleY', 1, lambda wkb: read_header_field(wkb, 'scaleY') if wkb else None)
+    conn.create_function('rt_SkewX', 1, lambda wkb: read_header_field(wkb, 'skewX') if wkb else None)
+    conn.create_function('rt_SkewY', 1, lambda wkb: read_header_field(wkb, 'skewY') if wkb else None)
+    conn.create_function('rt_UpperLeftX', 1, lambda wkb: read_header_field(wkb, 'ipX') if wkb else None)
+    conn.create_function('rt_UpperLeftY', 1, lambda wkb: read_header_field(wkb, 'ipY') if wkb else None)
+    conn.create_function('rt_NumBands', 1, lambda wkb: read_header_field(wkb, 'numbands') if wkb else None)
     conn.create_function('rt_GeoReference', 1, lambda wkb: json.dumps(Raster(wkb).georeference()) if wkb else None)
     conn.create_function('rt_MetaData', 1, lambda wkb: json.dumps(Raster(wkb).metadata()) if wkb else None)
 
@@ -148,7 +213,10 @@ class RT_SameAlignment(object):
 
 class RT_SummaryStatsAgg(object):
     def __init__(self):
-        self.result = None
+        # count, mean and sum of squared differences are merged tile by tile,
+        # so the stddev is exact without a second pass over the tiles
+        self.stats = RunningStats()
+        self.empty = True
 
     def step(self, *args):
         if args[0] is None:
@@ -172,29 +240,15 @@ class RT_SummaryStatsAgg(object):
             nband = 1
             exclude_nodata_value = True
 
-        # calc stats
-        stats = rast.summarystats(nband, exclude_nodata_value)
-
-        # update results
-        if self.result:
-            self.result['sum'] += stats['sum']
-            self.result['count'] += stats['count']
-            self.result['min'] = min(self.result['min'], stats['min'])
-            self.result['max'] = max(self.result['max'], stats['max'])
-            # what about stdev...? 
-            # ... 
-
-        else:
-            self.result = stats
+        # add the band values directly, without the summarystats dict
+        self.stats.add(rast._values(nband, exclude_nodata_value))
+        self.empty = False
 
     def finalize(self):
-        # make final calc
-        self.result['mean'] = self.result['sum'] / float(self.result['count'])
-        # what about stdev...?
-        # ...
-        self.result.pop('stddev')
+        if self.empty:
+            return None
         # dump to string (only used within the db)
-        dictstr = json.dumps(self.result)
+        dictstr = json.dumps(self.stats.result())
         return dictstr
 
 class RT_Union(object):
@@ -301,6 +355,8 @@ class Raster(object):
     def __init__(self, wkb):
         self._wkb = memoryview(wkb)
         self._header = None
+        self._bands = None
+        self._affine_cache = None
 
 ##    def __repr__(self):
 ##        return "<Raster data: dtype={dtype} bands={bands} size={size} bbox={bbox}>".format(dtype=None, #self.dtype,
@@ -320,92 +376,77 @@ class Raster(object):
         # ...so will fail if unioning very large rasters, which I guess is okay
         # ...since the purpose is to work with tiles iteratively
     
-        (endian,) = unpack_from('<b', self._wkb)
-
-        if endian == 0:
-            endian = '>'
-        elif endian == 1:
-            endian = '<'
-
-        (version, bands, scaleX, scaleY, ipX, ipY, skewX, skewY,
-         srid, width, height) = unpack_from(endian + 'xHHddddddIHH', self._wkb)
+        self._header = RasterHeader(self._wkb)
 
-        self._header = dict()
-        self._header['endian'] = endian
-        self._header['version'] = version
-        self._header['scaleX'] = scaleX
-        self._header['scaleY'] = scaleY
-        self._header['ipX'] = ipX
-        self._header['ipY'] = ipY
-        self._header['skewX'] = skewX
-        self._header['skewY'] = skewY
-        self._header['srid'] = srid
-        self._header['width'] = width
-        self._header['height'] = height
-        self._header['numbands'] = bands
-
-        self._affine = Affine(scaleX, skewX, ipX,
-                              skewY, scaleY, ipY)
+    @property
+    def _affine(self):
+        if self._affine_cache is None:
+            if not self._header:
+                self._load_header()
+            h = self._header
+            self._affine_cache = Affine(h.scaleX, h.skewX, h.ipX,
+                                        h.skewY, h.scaleY, h.ipY)
+        return self._affine_cache
 
     @property
     def width(self):
         if not self._header:
             self._load_header()
-        return self._header['width']
+        return self._header.width
 
     @property
     def height(self):
         if not self._header:
             self._load_header()
-        return self._header['height']
+        return self._header.height
 
     @property
     def numbands(self):
         if not self._header:
             self._load_header()
-        return self._header['numbands']
+        return self._header.numbands
 
     @property
     def scaleX(self):
         if not self._header:
             self._load_header()
-        return self._header['scaleX']
+        return self._header.scaleX
 
     @property
     def scaleY(self):
         if not self._header:
             self._load_header()
-        return self._header['scaleY']
+        return self._header.scaleY
 
     @property
     def skewX(self):
         if not self._header:
             self._load_header()
-        return self._header['skewX']
+        return self._header.skewX
 
     @property
     def skewX(self):
         if not self._header:
             self._load_header()
-        return self._header['skewX']
+        return self._header.skewX
 
     @property
     def skewY(self):
         if not self._header:
             self._load_header()
-        return self._header['skewY']
+        return self._header.skewY
 
     @property
     def upperLeftX(self):
         if not self._header:
             self._load_header()
-        return self._header['ipX']
+        return self._header.ipX
 
     @property
     def upperLeftY(self):
         if not self._header:
             self._load_header()
-        return self._header['ipY']
+        return self._header.ipY
 
     def georeference(self):
         if not self._header:
@@ -440,20 +481,20 @@ class Raster(object):
 
     def box2d(self):
         xmin,ymin,xmax,ymax = self.bbox()
-        pointbox = Geometry(shp=MultiPoint([(xmin,ymin),(xmax,ymax)]))
+        pointbox = Geometry(write_box2d(xmin,ymin,xmax,ymax))
         return pointbox
 
     def envelope(self):
         xmin,ymin,xmax,ymax = self.bbox()
-        polygon = Geometry(shp=Polygon([(xmin,ymin),(xmin,ymax),(xmax,ymax),(xmax,ymin),(xmin,ymin)]))
+        polygon = Geometry(write_polygon([[(xmin,ymin),(xmin,ymax),(xmax,ymax),(xmax,ymin),(xmin,ymin)]]))
         return polygon
 
     def convex_hull(self):
         w,h = self.width,self.height
         corners = [(0,0),(0,h-1),(w-1,h-1),(w-1,0)]
         coords = [self.raster_to_world_coord(px,py).as_GeoJSON()['coordinates'] for px,py in corners]
-        coords.append(coords[-1])
-        polygon = Geometry(shp=Polygon(coords))
+        coords.append(coords[0]) # close the ring
+        polygon = Geometry(write_polygon([coords]))
         return polygon
 
     # setting
@@ -466,10 +507,10 @@ class Raster(object):
 
         # TODO: make sure this is the correct affine sequence...
         ang = math.degrees(rotation)
-        self._affine = self._affine * Affine.rotation(ang)
+        affine = self._affine * Affine.rotation(ang)
 
         # update params
-        xscale,xskew,xoff, yskew,yscale,yoff, _,_,_ = list(self._affine)
+        xscale,xskew,xoff, yskew,yscale,yoff, _,_,_ = list(affine)
         self.set_scale(xscale, yscale)
         self.set_skew(xskew, yskew)
 
@@ -481,6 +522,7 @@ class Raster(object):
             
         self._header['scaleX'] = scaleX
         self._header['scaleY'] = scaleY
+        self._affine_cache = None
 
         # affines start after 'bHH' in the order of scaleX,scaleY,ipX,ipY,skewX,skewY
         endian = self._header['endian']
@@ -494,6 +536,7 @@ class Raster(object):
             
         self._header['skewX'] = skewX
         self._header['skewY'] = skewY
+        self._affine_cache = None
 
         # affines start after 'bHH' in the order of scaleX,scaleY,ipX,ipY,skewX,skewY
         endian = self._header['endian']
@@ -507,6 +550,7 @@ class Raster(object):
             
         self._header['ipX'] = upperLeftX
         self._header['ipY'] = upperLeftY
+        self._affine_cache = None
 
         # affines start after 'bHH' in the order of scaleX,scaleY,ipX,ipY,skewX,skewY
         endian = self._header['endian']
@@ -538,50 +582,54 @@ class Raster(object):
 
     # bands
 
-    def _band_start(self, i):
+    def _load_bands(self):
+        # walk the bands once and keep their headers and byte offsets,
+        # so that any band can be looked up directly afterwards
         if not self._header:
             self._load_header()
 
-        skip = 1+60 #calcsize('bHHddddddIHH') # raster header
-
-        _i = 1
-        while _i < i:
-        
-            bandsize = self._band_size(skip)
-            skip += bandsize
-
-            _i += 1
+        endian = self._header['endian']
+        pixels = self._header['width'] * self._header['height']
+        self._bands = []
+        start = 1+60 #calcsize('bHHddddddIHH') # raster header
+        for _ in range(self._header['numbands']):
+            # Requires reading a single byte, and splitting the bits into the
+            # header attributes
+            (bits,) = unpack_from(endian + 'b', self._wkb, offset=start)
+            pixtype = bits & int('00001111', 2) # bits 5-8
+            size = PIXTYPE_SIZES[pixtype]
+            (nodata,) = unpack_from(endian + PIXTYPE_FMTS[pixtype], self._wkb, offset=start+1)
+
+            band = dict()
+            band['isOffline'] = bool(bits & 128)  # first bit
+            band['hasNodataValue'] = bool(bits & 64)  # second bit
+            band['isNodataValue'] = bool(bits & 32)  # third bit
+            band['pixtype'] = pixtype
+            band['nodata'] = nodata
+            band['start'] = start
+            band['dataStart'] = start + 1 + size
+            if band['isOffline']:
+                raise Exception('Offline raster bands are not supported')
+            band['size'] = 1 + size + pixels * size
+            self._bands.append(band)
+
+            start += band['size']
+
+    def _band(self, i):
+        if self._bands is None:
+            self._load_bands()
+        if not 1 <= i <= len(self._bands):
+            raise Exception('Band {} does not exist, raster has {} bands'.format(i, len(self._bands)))
+        return self._bands[i-1]
 
-        return skip
+    def _band_start(self, i):
+        return self._band(i)['start']
 
     def _band_header(self, i):
-        if not self._header:
-            self._load_header()
-
+        band = self._band(i)
         header = dict()
-        start = self._band_start(i)
-
-        # Requires reading a single byte, and splitting the bits into the
-        # header attributes
-        endian = self._header['endian']
-        (bits,) = unpack_from(endian + 'b', self._wkb, offset=start)
-
-        header['isOffline'] = bool(bits & 128)  # first bit
-        header['hasNodataValue'] = bool(bits & 64)  # second bit
-        header['isNodataValue'] = bool(bits & 32)  # third bit
-
-        pixtype = bits & int('00001111', 2) # bits 5-8
-        header['pixtype'] = pixtype
-
-        # Based on the pixel type, determine the data type byte size
-        fmts = ['?', 'B', 'B', 'b', 'B', 'h',
-                'H', 'i', 'I', 'f', 'd']
-        fmt = fmts[pixtype]
-
-        # Read the nodata value
-        (nodata,) = unpack_from(endian + fmt, self._wkb, offset=start+1)
-        header['nodata'] = nodata
-
+        for k in ('isOffline','hasNodataValue','isNodataValue','pixtype','nodata'):
+            header[k] = band[k]
         return header
 
     def _write_band_header(self, header):
@@ -622,35 +670,8 @@ class Raster(object):
 
         return wkb
 
-    def _band_size(self, start):
-        #print 'band start',start
-        skip = 0
-        
-        # Requires reading a single byte, and splitting the bits into the
-        # header attributes
-        endian = self._header['endian']
-        (bits,) = unpack_from(endian + 'b', self._wkb, offset=start)
-        skip += 1
-
-        # Based on the pixel type, determine the data type byte size
-        pixtype = bits & int('00001111', 2) # bits 5-8
-        sizes = [1, 1, 1, 1, 1, 2, 2, 4, 4, 4, 8]
-        size = sizes[pixtype]
-
-        # Skip nodataval
-        skip += size
-
-        # Skip data
-        isOffline = bool(bits & 128)  # first bit
-        if isOffline:
-            raise Exception
-        
-        else:
-            arraysize = self._header['width'] * self._header['height'] * size
-            skip += arraysize
-
-        #print 'band size',skip
-        return skip
+    def _band_size(self, i):
+        return self._band(i)['size']
 
     def band(self, i):
         '''Returns a new raster containing only the specified bands'''
@@ -682,7 +703,7 @@ class Raster(object):
         for bandnum in bands:
             #print 'band',repr(bandnum)
             start = self._band_start(bandnum)
-            bandsize = self._band_size(start)
+            bandsize = self._band_size(bandnum)
             wkb += self._wkb[start:start+bandsize].tobytes()
 
         wkb_mem = memoryview(wkb)
@@ -690,104 +711,67 @@ class Raster(object):
         return rast
 
     def nodataval(self, band=1):
-        if not self._header:
-            self._load_header()
-
-        start = self._band_start(band)
-
-        endian = self._header['endian']
-        (bits,) = unpack_from(endian + 'b', self._wkb, offset=start)
-
-        # Based on the pixel type, determine the data type
-        pixtype = bits & int('00001111', 2) # bits 5-8
-
-        fmts = ['?', 'B', 'B', 'b', 'B', 'h',
-                'H', 'i', 'I', 'f', 'd']
-        fmt = fmts[pixtype]
-
-        # Read the nodata value
-        (nodata,) = unpack_from(endian + fmt, self._wkb, offset=start+1)
-        hasNodataValue = bool(bits & 64)  # second bit
-        return nodata if hasNodataValue else None
+        header = self._band(band)
+        return header['nodata'] if header['hasNodataValue'] else None
 
     def pixel_type(self, band=1):
         '''Returns the numpy data type'''
-        if not self._header:
-            self._load_header()
+        return PIXTYPE_DTYPES[self._band(band)['pixtype']]
 
-        start = self._band_start(band)
+    def data(self, band=1, masked=True):
+        '''Returns band data as numpy masked array, where pixels equal to the nodata value are masked.
+        If masked is False, returns the plain array read directly from the wkb, without a mask.'''
+        header = self._band(band)
+        dtype = PIXTYPE_DTYPES[header['pixtype']]
+        size = PIXTYPE_SIZES[header['pixtype']]
+        offset = header['dataStart']
 
-        endian = self._header['endian']
-        (bits,) = unpack_from(endian + 'b', self._wkb, offset=start)
-
-        # Based on the pixel type, determine the data type
-        pixtype = bits & int('00001111', 2) # bits 5-8
-
-        dtypes = ['b1', 'u1', 'u1', 'i1', 'u1', 'i2',
-                  'u2', 'i4', 'u4', 'f4', 'f8']
-        dtype = dtypes[pixtype]
-
-        return dtype
-
-    def data(self, band=1):
-        '''Returns band data as numpy array'''
-        if not self._header:
-            self._load_header()
-
-        start = self._band_start(band)
-        skip = 0
-
-        endian = self._header['endian']
-        (bits,) = unpack_from(endian + 'b', self._wkb, offset=start)
-        skip += 1
-
-        # Based on the pixel type, determine the data type
-        pixtype = bits & int('00001111', 2) # bits 5-8
-
-        fmts = ['?', 'B', 'B', 'b', 'B', 'h',
-                'H', 'i', 'I', 'f', 'd']
-        dtypes = ['b1', 'u1', 'u1', 'i1', 'u1', 'i2',
-                  'u2', 'i4', 'u4', 'f4', 'f8']
-        sizes = [1, 1, 1, 1, 1, 2, 2, 4, 4, 4, 8]
-        fmt = fmts[pixtype]
-        dtype = dtypes[pixtype]
-        size = sizes[pixtype]
-
-        # Read nodataval
-        hasNodataValue = bool(bits & 64)  # second bit
-        if hasNodataValue:
-            (nodata,) = unpack_from(endian + fmt, self._wkb, offset=start+1)
-        skip += size
-
-        # Read data
-        isOffline = bool(bits & 128)  # first bit
-        if isOffline:
-            raise Exception
-        
+        width,height = self._header['width'], self._header['height']
+        if PY2:
+            # py2: ndarray buffer doesnt accept memview
+            # instead extract raw bytes and read from that
+            length = size*width*height
+            raw = self._wkb[offset:offset+length].tobytes()
+            data = np.fromstring(raw, dtype=np.dtype(dtype)).reshape((height, width))
         else:
-            width,height = self._header['width'], self._header['height']
-            if PY2:
-                # py2: ndarray buffer doesnt accept memview
-                # instead extract raw bytes and read from that
-                length = size*width*height
-                offset = start+skip
-                length = size*width*height
-                raw = self._wkb[offset:offset+length].tobytes()
-                data = np.fromstring(raw, dtype=np.dtype(dtype)).reshape((height, width))
-            else:
-                # py3
-                data = np.ndarray((height, width),
-                                  buffer=self._wkb, offset=start+skip,
-                                  dtype=np.dtype(dtype)
-                                  )
-            if hasNodataValue:
-                mask = data == nodata
-            else:
-                mask = False
-            data = ma.array(data, mask=mask)
+            # py3
+            data = np.ndarray((height, width),
+                              buffer=self._wkb, offset=offset,
+                              dtype=np.dtype(dtype)
+                              )
+        if not masked:
+            return data
+
+        mask = self.nodata_mask(band, data)
+        if mask is None:
+            mask = ma.nomask
+        data = ma.array(data, mask=mask)
 
         return data
 
+    def nodata_mask(self, band=1, data=None):
+        '''Returns a boolean array of where the band equals the nodata value, or None if the band has no nodata value.
+        Data is the plain band array, if already read.'''
+        header = self._band(band)
+        if not header['hasNodataValue']:
+            return None
+        if data is None:
+            data = self.data(band, masked=False)
+        nodata = header['nodata']
+        if nodata != nodata:
+            # nan nodata value
+            return np.isnan(data)
+        return data == nodata
+
+    def _values(self, band=1, exclude_nodata_value=True):
+        # flat array of the band values, without the nodata values
+        data = self.data(band, masked=False)
+        if exclude_nodata_value is not False:
+            mask = self.nodata_mask(band, data)
+            if mask is not None:
+                return data[~mask]
+        return data.ravel()
+
     def summarystats(self, *args):
         # should return: count | sum  |    mean    |  stddev   | min | max
 
@@ -806,17 +790,10 @@ class Raster(object):
             exclude_nodata_value = True
 
         # get stats
-        arr = self.data(nband)
-        if exclude_nodata_value is False:
-            arr = np.array(arr) # full array without mask
-        stats = {'count': int(arr.count()),
-                 'sum': float(arr.sum()),
-                 'mean': float(arr.mean()),
-                 'stddev': float(np.std(arr)),
-                 'min': float(arr.min()),
-                 'max': float(arr.max()),
-                 }
-        return stats
+        # reducing the plain values is several times faster than reducing a masked array
+        stats = RunningStats()
+        stats.add(self._values(nband, exclude_nodata_value))
+        return stats.result()
 
 
     # changing
@@ -867,7 +844,7 @@ class Raster(object):
             wkb += self._write_band_header(bandhead)
 
             # resize the data
-            arr = self.data(bandnum)
+            arr = self.data(bandnum, masked=False)
             im = Image.fromarray(arr)
             method = {'nearestneighbor': Image.NEAREST,
                       'nearestneighbour': Image.NEAREST,
@@ -879,7 +856,7 @@ class Raster(object):
 
             if bandhead['hasNodataValue']:
                 # also resize mask and write nodatavals into resulting array
-                mask_im = Image.fromarray(arr.mask)
+                mask_im = Image.fromarray(self.nodata_mask(bandnum, arr))
                 mask_result = mask_im.resize((width,height), Image.NEAREST)
                 arr_result[mask_result] = bandhead['nodata']
                 
@@ -984,9 +961,6 @@ class Raster(object):
             endianFmt = header['endian']
             header['endian'] = 1 if header['endian'] == '<' else 0
             header['numbands'] = 1
-            if nodataval != None:
-                header['hasNodataValue'] = True
-                header['nodataval'] = nodataval
             headervals = [header[k] for k in 'version,numbands,scaleX,scaleY,ipX,ipY,skewX,skewY,srid,width,height'.split(',')]
             wkb += pack('<b', header['endian'])
             wkb += pack(endianFmt + 'HHddddddIHH', *headervals)
@@ -997,84 +971,26 @@ class Raster(object):
             dtypes = ['b1', 'u1', 'u1', 'i1', 'u1', 'i2',
                       'u2', 'i4', 'u4', 'f4', 'f8']
             bandhead['pixtype'] = dtypes.index(pixeltype)
+            if nodataval != None:
+                bandhead['hasNodataValue'] = True
+                bandhead['nodata'] = nodataval
+            if bandhead['hasNodataValue']:
+                bandhead['nodata'] = np.dtype(pixeltype).type(bandhead['nodata']).item()
             
             # write band headers
             wkb += self._write_band_header(bandhead)
 
-            # set environment
-            arr = self.data(nband)
+            # calculate on the plain values, and set nodata pixels afterwards
+            arr = self.data(nband, masked=False)
             arr = arr.astype(np.dtype(pixeltype))
-            locenv = {'rast': arr, 'np': np}
-
-            # parse expression
-            expression = expression.lower()
-
-            def sql2py(sql):
-                # TODO: support multiple and/or statements
-                # ... 
-
-                # convert rast references
-                sql = sql.replace('[rast]', 'rast')
-
-                # equal condition
-                # TODO: Need fix if = without spaces
-                sql = sql.replace(' = ', ' == ')
-
-                # max min
-                sql = sql.replace('max(', 'np.maximum(')
-                sql = sql.replace('min(', 'np.minimum(')
-                
-                # between clause, ie "col BETWEEN v1 AND v2"
-                if 'between' in sql:
-                    col,bw = sql.split(' between ')
-                    vmin,vmax = bw.split(' and ')
-                    sql = '({vmin} <= {col}) & ({col} <= {vmax})'.format(vmin=vmin, col=col, vmax=vmax)
-                    
-                return sql
-
-            # calculate
-            if expression.startswith('case'):
-                # conditional expression
-                # ie: case when then ... when then ... else
-                expression = expression.replace('case when ', '')
-                whenpart,elsepart = expression.split(' else ')
-                
-                whens = whenpart.split(' when ')
-                when_cumul = np.zeros(arr.shape, dtype=bool)
-                arr_result = arr.copy()
-                for when in whens:
-                    when,then = when.split(' then ')
-
-                    # perform the math
-                    pyexpr = sql2py(when)
-                    #print 'when', pyexpr
-                    when_result = eval(pyexpr, {}, locenv)
-                    if np.any(when_result):
-                        when_result = when_result & (when_result ^ when_cumul) # exclude previous when-pixels
-                        when_cumul = when_cumul | when_result # update cumulative when-pixels
-
-                        pyexpr = sql2py(then)
-                        #print 'then', pyexpr
-                        then_result = eval(pyexpr, {}, locenv)
-
-                        # set values in results
-                        arr_result[when_result] = then_result
-
-                # final else clause
-                remain = ~when_cumul
-                if np.any(remain):
-                    elsepart = elsepart.replace(' end', '')
-                    pyexpr = sql2py(elsepart)
-                    #print 'else', pyexpr
-                    else_result = eval(pyexpr, {}, locenv)
-
-                    # set values in results
-                    arr_result[remain] = else_result
-
-            else: 
-                # simple expression
-                pyexpr = sql2py(expression)
-                arr_result = eval(pyexpr, {}, locenv)
+            expr = compile_expression(expression)
+            null = bandhead['nodata'] if bandhead['hasNodataValue'] else 0
+            arr_result = np.empty(arr.shape, dtype=np.dtype(pixeltype))
+            expr.evaluate({'rast': arr}, null, out=arr_result)
+
+            nodata_mask = self.nodata_mask(nband)
+            if nodata_mask is not None:
+                arr_result[nodata_mask] = null
                 
             # byteswap
             #if endianFmt != arr_result.dtype.byteorder:
@@ -1248,11 +1164,8 @@ class Raster(object):
             if nodata2expr:
                 
                 # calculate paste value
-                pyexpr = nodata2expr.lower()
-                pyexpr = pyexpr.replace('[rast1]','rast1')
-                locenv = {'rast1': arr1frame}
-                nodata2_result = eval(pyexpr, {}, locenv)
-                if isinstance(nodata2_result, (float,int)):
+                nodata2_result = compile_expression(nodata2expr).evaluate({'rast1': arr1frame.data})
+                if np.ndim(nodata2_result) == 0:
                     # constant
                     arr1_paste = np.ones(arr1frame.shape, dtype=arr1frame.dtype) * nodata2_result
                 else:
@@ -1315,11 +1228,8 @@ class Raster(object):
             if nodata1expr:
                 
                 # calculate paste value
-                pyexpr = nodata1expr.lower()
-                pyexpr = pyexpr.replace('[rast2]','rast2')
-                locenv = {'rast2': arr2frame}
-                nodata1_result = eval(pyexpr, {}, locenv)
-                if isinstance(nodata1_result, (float,int)):
+                nodata1_result = compile_expression(nodata1expr).evaluate({'rast2': arr2frame.data})
+                if np.ndim(nodata1_result) == 0:
                     # constant
                     arr2_paste = np.ones(arr2frame.shape, dtype=arr2frame.dtype) * nodata1_result
                 else:
@@ -1348,93 +1258,10 @@ class Raster(object):
             if np.any(~isec_mask):
                 #print 'isec pixel bounds', startX, startY, endX, endY
 
-                # set environment
-                #print 'isec dims',arr1clip.shape,arr2clip.shape
-                arr1frame.mask = isec_mask
-                arr2frame.mask = isec_mask
-                locenv = {'rast1': arr1frame, 'rast2': arr2frame, 'np': np}
-
-                # parse expression
-                expression = expression.lower()
-
-                def sql2py(sql):
-                    # TODO: support multiple and/or statements
-                    # ... 
-
-                    # convert rast references
-                    sql = sql.replace('[rast1]', 'rast1').replace('[rast2]', 'rast2')
-
-                    # equal condition
-                    # TODO: Need fix if = without spaces
-                    sql = sql.replace(' = ', ' == ')
-
-                    # max min
-                    sql = sql.replace('max(', 'np.maximum(')
-                    sql = sql.replace('min(', 'np.minimum(')
-                    
-                    # between clause, ie "col BETWEEN v1 AND v2"
-                    if 'between' in sql:
-                        col,bw = sql.split(' between ')
-                        vmin,vmax = bw.split(' and ')
-                        sql = '({vmin} <= {col}) & ({col} <= {vmax})'.format(vmin=vmin, col=col, vmax=vmax)
-                        
-                    return sql
-
-                # compute expression for the clipped grids
-                if expression.startswith('case'):
-                    # conditional expression
-                    # ie: case when then ... when then ... else
-                    expression = expression.replace('case when ', '')
-                    whenpart,elsepart = expression.split(' else ')
-                    
-                    whens = whenpart.split(' when ')
-                    when_cumul = np.zeros(frame_result.shape, dtype=bool)
-
-                    # isect result starts out as fully masked array of nodatanodataval
-                    isec_result = np.ones(frame_result.shape, dtype=pixeltype) * nodatanodataval
-                    
-                    #when_cumul = np.zeros((height,width), dtype=bool)
-                    #arr_result = np.zeros((height,width), dtype=pixeltype)
-                    
-                    for when in whens:
-                        when,then = when.split(' then ')
-
-                        # perform the math
-                        pyexpr = sql2py(when)
-                        #print 'when', pyexpr
-                        when_result = eval(pyexpr, {}, locenv)
-                        if np.any(when_result):
-                            when_result = when_result & (when_result ^ when_cumul) # exclude previous when-pixels
-                            when_cumul = when_cumul | when_result # update cumulative when-pixels
-
-                            pyexpr = sql2py(then)
-                            #print 'then', pyexpr
-                            then_result = eval(pyexpr, {}, locenv)
-
-                            # set values in results
-                            isec_result[when_result] = then_result
-
-                    # final else clause
-                    remain = ~when_cumul
-                    if np.any(remain):
-                        elsepart = elsepart.replace(' end', '')
-                        pyexpr = sql2py(elsepart)
-                        #print 'else', pyexpr
-                        else_result = eval(pyexpr, {}, locenv)
-
-                        # set values in results
-                        isec_result[remain] = else_result
-
-                else:
-                    # simple expression
-                    pyexpr = sql2py(expression)
-                    isec_calc = eval(pyexpr, {}, locenv)
-                    if isinstance(isec_calc, (float,int)):
-                        # constant
-                        isec_result = np.ones(frame_result.shape, dtype=arr1.dtype) * isec_calc
-                    else:
-                        # array
-                        isec_result = isec_calc
+                # compute expression for the common grid, results outside the intersection are discarded
+                expr = compile_expression(expression)
+                isec_result = np.empty(frame_result.shape, dtype=np.dtype(pixeltype))
+                expr.evaluate({'rast1': arr1frame.data, 'rast2': arr2frame.data}, nodatanodataval, out=isec_result)
 
                 # paste final expression results onto the intersecting region
                 #frame_result[~isec_mask] = isec_result[~isec_mask]
@@ -1508,6 +1335,30 @@ class Raster(object):
         result = self.mapalgebra(band1, rast2, band2, expr, pixeltype, 'intersection')
         return result
 
+    def _geometry_window(self, geom, touched=False):
+        '''Rasterizes a geom only within the pixel window where the raster and the geom bbox overlap.
+        Returns the (row0,row1,col0,col1) window and the boolean mask of the geom within it,
+        or None if they dont overlap.'''
+        if not self._header:
+            self._load_header()
+        xmin,ymin,xmax,ymax = geom.bbox()
+        if math.isnan(xmin):
+            return None
+        inv = ~self._affine
+        corners = [inv * (x,y) for x,y in [(xmin,ymin),(xmin,ymax),(xmax,ymax),(xmax,ymin)]]
+        cols,rows = zip(*corners)
+        col0 = max(int(math.floor(min(cols))), 0)
+        row0 = max(int(math.floor(min(rows))), 0)
+        col1 = min(int(math.ceil(max(cols))), self.width)
+        row1 = min(int(math.ceil(max(rows))), self.height)
+        if col0 >= col1 or row0 >= row1:
+            return None
+
+        # shift the pixel coords to the window origin
+        a,b,c,d,e,f = list(inv)[:6]
+        mask = geometry_mask(geom._parsed(), (a,b,c-col0,d,e,f-row0), col1-col0, row1-row0, touched)
+        return (row0,row1,col0,col1), mask
+
     def clip(self, *args):
         '''
         Variant 1:
@@ -1519,10 +1370,8 @@ class Raster(object):
         Variant 4:
             geometry geom, [boolean crop=TRUE]
         '''
-        # NOTE: in postgis, all bands are included in result if none specified
-        # ...for now we just only clip one band (default is band 1)
-        # TODO: sort of works, but have to check more thouroughly...
-        # ........
+        # same as postgis, all bands are included in result if none specified
+        # only the window where the raster and the geom bbox overlap is rasterized
         if not self._header:
             self._load_header()
             
@@ -1547,6 +1396,9 @@ class Raster(object):
                     nodataval = None
                 else:
                     raise Exception('Invalid function args: {}'.format(args))
+            else:
+                nodataval = None
+                crop = True
         else:
             if isinstance(args[0], Geometry):
                 geom = args[0]
@@ -1554,7 +1406,7 @@ class Raster(object):
                 wkb = args[0]
                 geom = Geometry(wkb)
                 
-            nband = 1 # assume one, but should actually be ALL
+            nband = None # all bands
             if len(args) >= 2:
                 if isinstance(args[1], float):
                     # geometry geom, double precision nodataval, boolean crop=TRUE
@@ -1573,57 +1425,53 @@ class Raster(object):
         # quit early?
         if geom is None:
             return None
-        if not geom.intersects(self.envelope()):
-            return None
 
-        # determine nodataval
-        if nodataval is None:
-            nodataval = self.nodataval(nband)
-        if nodataval is None:
-            # should be set to ST_MinPossibleValue(ST_BandPixelType(rast, band))
-            raise Exception('nodataval must be set')
+        # rasterize the geom within the window where it overlaps the raster
+        window = self._geometry_window(geom)
+        if window is None:
+            return None
+        (row0,row1,col0,col1),mask = window
+        if not mask.any() and not geom.intersects(self.envelope()):
+            return None
 
-        # rasterize the geom to be used as the clipper
+        # write raster header, cropped to the window or same as rast
+        bands = [nband] if nband else range(1, self.numbands+1)
+        header = self._header.copy()
         if crop:
-            # only need to rasterize within the intersection of rast and geom
-            # NOTE: for now just rasterize entire geom aligned, will be clipped correctly in next step
-            # scalex, scaley, pixeltype, [value=1, nodataval=0, upperleftx=NULL, upperlefty=NULL, skewx=0, skewy=0]
-            georast = geom.as_raster(self.scaleX, self.scaleY,
-                                     self.upperLeftX, self.upperLeftY, # gridx,grid (ensures alignment)
-                                     'u1', 255, 0, # pixtype,value,nodata
-                                     self.skewX, self.skewY,
-                                     )
-
-        else:
-            # only need to rasterize within the extent of rast
-            # refraster, pixeltype, [value=1, nodataval=0]
-            ref = self
-            georast = geom.as_raster(ref, 'u1', 255, 0)
-
-        #Image.fromarray(georast.data()).show()
+            header['ipX'],header['ipY'] = self._affine * (col0, row0)
+            header['width'] = col1-col0
+            header['height'] = row1-row0
+        endianFmt = header['endian']
+        header['endian'] = 1 if header['endian'] == '<' else 0
+        header['numbands'] = len(bands)
+        headervals = [header[k] for k in 'version,numbands,scaleX,scaleY,ipX,ipY,skewX,skewY,srid,width,height'.split(',')]
+        wkb = pack('<b', header['endian'])
+        wkb += pack(endianFmt + 'HHddddddIHH', *headervals)
 
-        # clip the raster using intersection/mapalgebra
-        if crop:
-            # crop to the intersection of rast and geom
-            # band1, rast2, band2, [nodataval=NULL]
-            #clipped = self.intersection(nband, georast, 1, nodataval)
-            #print 'self',self.metadata()
-            #print 'georast',georast.metadata()
-            #print 'nd',georast.nodataval(1)
-            clipped = self.mapalgebra(nband, georast, 1, '[rast1]',
-                                      None, 'intersection',
-                                      None, None, nodataval)
+        # clip all bands in one pass, using the same mask
+        for band in bands:
+            bandnodata = nodataval if nodataval is not None else self.nodataval(band)
+            if bandnodata is None:
+                # should be set to ST_MinPossibleValue(ST_BandPixelType(rast, band))
+                raise Exception('nodataval must be set')
+            data = self.data(band, masked=False)
+            bandnodata = data.dtype.type(bandnodata).item()
+
+            window = np.where(mask, data[row0:row1, col0:col1], bandnodata)
+            if crop:
+                arr = window
+            else:
+                arr = np.full(data.shape, bandnodata, dtype=data.dtype)
+                arr[row0:row1, col0:col1] = window
 
-        else:
-            # gets same extent as rast
-            # nband1, rast2, nband2, expression, [text pixeltype=NULL, text extenttype=INTERSECTION, text nodata1expr=NULL, text nodata2expr=NULL, double precision nodatanodataval=NULL]
-            #print 'self',self.metadata()
-            #print 'georast',georast.metadata()
-            #print 'nd',georast.nodataval(1)
-            clipped = self.mapalgebra(nband, georast, 1, '[rast1]',
-                                      None, 'first',
-                                      None, None, nodataval)
+            bandheader = self._band_header(band)
+            bandheader['hasNodataValue'] = True
+            bandheader['isNodataValue'] = False
+            bandheader['nodata'] = bandnodata
+            wkb += self._write_band_header(bandheader)
+            wkb += arr.astype(data.dtype).tobytes()
 
+        clipped = Raster(memoryview(wkb))
         return clipped
 
 
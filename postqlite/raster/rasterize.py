@@ -0,0 +1,126 @@
+
+# burning geometries into pixel grids with numpy, directly from the parsed wkb coordinates
+# polygons are filled with the even-odd rule, sampled at the pixel centres (same as gdal),
+# and with touched=True also every pixel touched by their outline.
+# lines always burn all the pixels they pass through, and points the pixel they fall in.
+# geometries are the (type, dims, coords) tuples returned by geometry.wkb.read_geometry()
+
+import numpy as np
+
+from ..geometry.measure import _parts
+
+
+def _transform(coords, invaffine):
+    # world coords to fractional pixel coords
+    a,b,c,d,e,f = invaffine[:6]
+    x = coords[:, 0]
+    y = coords[:, 1]
+    return a*x + b*y + c, d*x + e*y + f
+
+def _ranges(starts, counts):
+    # concatenated aranges, ie for each start and count: start, start+1, ..., start+count-1
+    # along with the index of the range each value belongs to
+    counts = np.maximum(counts, 0)
+    index = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return index, np.repeat(starts, counts) + offsets
+
+def _edges(rings, invaffine):
+    # start and end pixel coords of all segments of the rings
+    x0s,y0s,x1s,y1s = [],[],[],[]
+    for ring in rings:
+        if len(ring) < 2:
+            continue
+        cols,rows = _transform(ring, invaffine)
+        x0s.append(cols[:-1])
+        y0s.append(rows[:-1])
+        x1s.append(cols[1:])
+        y1s.append(rows[1:])
+    if not x0s:
+        empty = np.zeros(0)
+        return empty, empty, empty, empty
+    return np.concatenate(x0s), np.concatenate(y0s), np.concatenate(x1s), np.concatenate(y1s)
+
+def _fill_spans(x0, y0, x1, y1, width, height, acc):
+    # even-odd scanline fill, adds +1 at the start and -1 at the end of each span to acc
+    # rows whose centre lies within the half open y range of each edge
+    ylo = np.minimum(y0, y1)
+    yhi = np.maximum(y0, y1)
+    rstart = np.clip(np.ceil(ylo - 0.5), 0, height).astype(int)
+    rend = np.clip(np.ceil(yhi - 0.5), 0, height).astype(int)
+    edge,rows = _ranges(rstart, rend - rstart)
+    if not len(rows):
+        return
+
+    # x where each edge crosses each row centre
+    ex0,ey0,ex1,ey1 = x0[edge],y0[edge],x1[edge],y1[edge]
+    xs = ex0 + (rows + 0.5 - ey0) / (ey1 - ey0) * (ex1 - ex0)
+
+    # each row has an even number of crossings, so once sorted every pair is a filled span
+    order = np.lexsort((xs, rows))
+    rows = rows[order]
+    xs = xs[order]
+    spanrows = rows[0::2]
+    # pixels whose centres lie within the span
+    c0 = np.clip(np.ceil(xs[0::2] - 0.5), 0, width).astype(int)
+    c1 = np.clip(np.ceil(xs[1::2] - 0.5), 0, width).astype(int)
+    np.add.at(acc, (spanrows, c0), 1)
+    np.add.at(acc, (spanrows, c1), -1)
+
+def _crossings(a0, b0, a1, b1, size):
+    # where segments cross the integer grid lines a=k, limited to k in 0..size
+    # returns the segment index, k, and the b coordinate of each crossing
+    alo = np.minimum(a0, a1)
+    ahi = np.maximum(a0, a1)
+    kstart = np.clip(np.floor(alo) + 1, 0, size + 1).astype(int)
+    kend = np.clip(np.ceil(ahi), 0, size + 1).astype(int)
+    seg,ks = _ranges(kstart, kend - kstart)
+    sa0,sb0,sa1,sb1 = a0[seg],b0[seg],a1[seg],b1[seg]
+    bs = sb0 + (ks - sa0) / (sa1 - sa0) * (sb1 - sb0)
+    return ks, np.floor(bs).astype(int)
+
+def _supercover(x0, y0, x1, y1, width, height, mask):
+    # marks all pixels touched by the segments, ie the pixels containing the endpoints,
+    # and the pixels on both sides of every grid line that a segment crosses
+    cols = [np.floor(x0).astype(int), np.floor(x1).astype(int)]
+    rows = [np.floor(y0).astype(int), np.floor(y1).astype(int)]
+    ks,crossrows = _crossings(x0, y0, x1, y1, width)
+    cols.extend([ks - 1, ks])
+    rows.extend([crossrows, crossrows])
+    ks,crosscols = _crossings(y0, x0, y1, x1, height)
+    rows.extend([ks - 1, ks])
+    cols.extend([crosscols, crosscols])
+    _mark(np.concatenate(cols), np.concatenate(rows), width, height, mask)
+
+def _mark(cols, rows, width, height, mask):
+    inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    mask[rows[inside], cols[inside]] = True
+
+
+def geometry_mask(geom, invaffine, width, height, touched=False):
+    '''Boolean (height,width) array of the pixels covered by a parsed wkb geometry,
+    where invaffine is the (a,b,c,d,e,f) affine transform from world to pixel coords.'''
+    mask = np.zeros((height, width), dtype=bool)
+    polys,lines,points = _parts(geom, [], [], [])
+
+    if polys:
+        acc = np.zeros((height, width + 1), dtype=np.int32)
+        for rings in polys:
+            x0,y0,x1,y1 = _edges(rings, invaffine)
+            _fill_spans(x0, y0, x1, y1, width, height, acc)
+            if touched:
+                _supercover(x0, y0, x1, y1, width, height, mask)
+        # overlapping spans of multipolygon parts add up, so anything above zero is inside
+        mask |= np.cumsum(acc, axis=1)[:, :width] > 0
+
+    if lines:
+        x0,y0,x1,y1 = _edges(lines, invaffine)
+        _supercover(x0, y0, x1, y1, width, height, mask)
+
+    for arr in points:
+        arr = arr[~np.isnan(arr[:, 0])] # empty points are stored as nan
+        cols,rows = _transform(arr, invaffine)
+        _mark(np.floor(cols).astype(int), np.floor(rows).astype(int), width, height, mask)
+
+    return mask
+
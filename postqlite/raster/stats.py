@@ -0,0 +1,92 @@
+
+# running statistics that can be accumulated over many tiles or zones without keeping the values around
+
+import numpy as np
+
+
+STATS = ('count', 'sum', 'mean', 'stddev', 'min', 'max')
+
+
+class RunningStats(object):
+    '''Accumulates count, sum, mean, stddev, min and max over batches of values,
+    and optionally a histogram of the number of pixels with each value.
+    The mean and variance of each batch are merged with the running ones using Chan's parallel algorithm,
+    which is numerically stable, unlike keeping a sum of squares.
+    See: https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    '''
+    def __init__(self, histogram=False):
+        self.count = 0
+        self.sum = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squared differences from the mean
+        self.min = None
+        self.max = None
+        self.histogram = {} if histogram else None
+
+    def add(self, values):
+        '''Adds a numpy array of values'''
+        values = np.asarray(values).ravel()
+        count = len(values)
+        if not count:
+            return
+        if self.histogram is not None:
+            # counted before converting to float, so integer values stay integers
+            uniq,counts = np.unique(values, return_counts=True)
+            for value,valuecount in zip(uniq.tolist(), counts.tolist()):
+                self.histogram[value] = self.histogram.get(value, 0) + valuecount
+        values = values.astype(np.float64)
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        self.merge(count, mean, m2, float(values.min()), float(values.max()), float(values.sum()))
+
+    def merge(self, count, mean, m2, minval, maxval, total=None):
+        '''Merges in the moments of another set of values'''
+        if not count:
+            return
+        newcount = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / float(newcount)
+        self.m2 += m2 + delta * delta * self.count * count / float(newcount)
+        self.count = newcount
+        self.sum += total if total is not None else mean * count
+        self.min = minval if self.min is None else min(self.min, minval)
+        self.max = maxval if self.max is None else max(self.max, maxval)
+
+    @property
+    def variance(self):
+        # population variance, same as postgis
+        if not self.count:
+            return None
+        return self.m2 / float(self.count)
+
+    @property
+    def stddev(self):
+        if not self.count:
+            return None
+        return self.variance ** 0.5
+
+    def result(self, stats=None):
+        '''Dict of the given stats, default all but the histogram'''
+        stats = stats or STATS
+        result = {}
+        for stat in stats:
+            if stat == 'count':
+                result['count'] = self.count
+            elif stat == 'sum':
+                result['sum'] = self.sum
+            elif stat == 'mean':
+                result['mean'] = self.mean if self.count else None
+            elif stat == 'stddev':
+                result['stddev'] = self.stddev
+            elif stat == 'variance':
+                result['variance'] = self.variance
+            elif stat == 'min':
+                result['min'] = self.min
+            elif stat == 'max':
+                result['max'] = self.max
+            elif stat == 'histogram':
+                result['histogram'] = self.histogram
+            else:
+                raise Exception('Unknown stat: {}'.format(stat))
+        return result
+
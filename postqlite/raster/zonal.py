@@ -0,0 +1,99 @@
+
+# zonal statistics of the raster values within each geom of a table, over a table of raster tiles
+# tiles are matched to zones by their extents, which are read from the raster headers alone,
+# and each tile is loaded once and used for all the zones that overlap it.
+# sqlite3 in python has no way to define table-valued functions, so the sql func rt_ZonalStats
+# returns a json object of stats for each zone rowid, which can be expanded with json_each:
+#
+#     select z.key as zone_id, json_extract(z.value, '$.mean') as mean
+#     from json_each(rt_ZonalStats('zones', 'geom', 'dem', 'rast', 1, 'count,mean')) as z
+
+import json
+
+import numpy as np
+
+from ..geometry.geometry import Geometry
+from ..geometry.index import _quote
+from .raster import Raster
+from .stats import RunningStats, STATS
+
+
+# the raster header is 1 byte for the endian and 60 bytes of metadata
+_HEADER_SIZE = 61
+
+
+def register_funcs(conn):
+    conn.create_function('rt_ZonalStats', -1, lambda *args: json.dumps(zonal_stats(conn, *args)) )
+
+
+def _tile_bbox(rast):
+    # bbox of all four outer corners of the raster
+    aff = rast._affine
+    w,h = rast.width, rast.height
+    xs,ys = zip(*[aff * (px,py) for px,py in [(0,0),(w,0),(w,h),(0,h)]])
+    return min(xs),min(ys),max(xs),max(ys)
+
+def _parse_stats(stats):
+    if not stats:
+        return list(STATS)
+    if isinstance(stats, (list,tuple)):
+        return list(stats)
+    return [stat.strip().lower() for stat in stats.split(',')]
+
+
+def zonal_stats(conn, geomtable, geomcolumn, rasttable, rastcolumn, band=1, stats=None):
+    '''Calculates stats of the band values of a raster tile column within each geom of a geom column.
+    Stats is a list or comma separated string of count, sum, mean, stddev, variance, min, max and histogram
+    (the number of pixels with each value), default all but variance and histogram.
+    Pixels are included if their centre is inside the geom, and nodata pixels are excluded.
+    Returns a dict of stats for each geom rowid.'''
+    stats = _parse_stats(stats)
+    band = int(band) if band else 1
+
+    # tile extents from the headers only
+    sql = 'select rowid, substr({col}, 1, {size}) from {table} where {col} is not null'.format(col=_quote(rastcolumn),
+                                                                                             table=_quote(rasttable),
+                                                                                             size=_HEADER_SIZE)
+    tileids = []
+    tilebboxes = []
+    for rowid,header in conn.execute(sql):
+        rast = Raster(header)
+        rast._load_header()
+        tileids.append(rowid)
+        tilebboxes.append(_tile_bbox(rast))
+    tilebboxes = np.array(tilebboxes, dtype=np.float64).reshape((-1, 4))
+
+    # zones and the tiles they overlap
+    sql = 'select rowid, {col} from {table} where {col} is not null'.format(col=_quote(geomcolumn),
+                                                                           table=_quote(geomtable))
+    zones = {}
+    accumulators = {}
+    tilezones = {}
+    for rowid,value in conn.execute(sql):
+        geom = value if isinstance(value, Geometry) else Geometry(value)
+        zones[rowid] = geom
+        accumulators[rowid] = RunningStats(histogram='histogram' in stats)
+        xmin,ymin,xmax,ymax = geom.bbox()
+        overlaps = ((tilebboxes[:, 2] >= xmin) & (tilebboxes[:, 0] <= xmax) &
+                    (tilebboxes[:, 3] >= ymin) & (tilebboxes[:, 1] <= ymax))
+        for i in np.nonzero(overlaps)[0].tolist():
+            tilezones.setdefault(tileids[i], []).append(rowid)
+
+    # load each tile once, and burn each overlapping zone within the window where they overlap
+    sql = 'select {col} from {table} where rowid = ?'.format(col=_quote(rastcolumn), table=_quote(rasttable))
+    for tileid,zoneids in tilezones.items():
+        (value,) = conn.execute(sql, (tileid,)).fetchone()
+        rast = value if isinstance(value, Raster) else Raster(value)
+        values = rast.data(band, masked=False)
+        nodata = rast.nodata_mask(band, values)
+        valid = ~nodata if nodata is not None else np.ones(values.shape, dtype=bool)
+        for zoneid in zoneids:
+            window = rast._geometry_window(zones[zoneid])
+            if window is None:
+                continue
+            (row0,row1,col0,col1),mask = window
+            mask &= valid[row0:row1, col0:col1]
+            accumulators[zoneid].add(values[row0:row1, col0:col1][mask])
+
+    return dict([(rowid, acc.result(stats)) for rowid,acc in accumulators.items()])
+
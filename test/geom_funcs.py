@@ -201,6 +201,111 @@ for row in cur.execute('select st_asText(st_extent(geom)) from test'):
     print row
     break
 
+##############
+# spatial index
+
+print 'spatial index'
+postqlite.geometry.create_spatial_index(db, 'test', 'geom')
+cur.execute('insert into test values (st_Point(1,1), st_Point(1,1))')
+for row in cur.execute('select count(*) from idx_test_geom'):
+    print row
+for row in cur.execute('''select count(*) from test, idx_test_geom as i
+                            where test.rowid = i.id
+                            and i.xmax >= 0 and i.xmin <= 2 and i.ymax >= 0 and i.ymin <= 2'''):
+    print row
+# empty geoms are not indexed, and changed rowids are followed
+cur.execute("insert into test values (st_GeomFromText('POINT EMPTY'), st_Point(1,1))")
+cur.execute('update test set rowid = -1 where rowid = (select max(rowid) from test where st_Xmin(geom) is not null)')
+for row in cur.execute('select count(*), min(id) from idx_test_geom'):
+    print row
+postqlite.geometry.drop_spatial_index(db, 'test', 'geom')
+
+# geometry cache
+print 'geometry cache'
+for row in cur.execute('select st_intersects(geom,geom2), st_area(geom), st_area(geom2) from test'):
+    pass
+for row in cur.execute('select st_CacheInfo()'):
+    print row
+cur.execute('select st_ClearCache()')
+
+# embedded bbox blobs
+print 'embedded bbox blobs'
+postqlite.geometry.blob.convert_column(db, 'test', 'geom')
+for row in cur.execute('select st_xmin(geom), st_srid(geom), st_asText(box2d(geom)) from test'):
+    print row
+    break
+postqlite.geometry.blob.convert_column(db, 'test', 'geom', embed_bbox=False)
+
+# agg parallel union
+print 'agg parallel union'
+for row in cur.execute('select geometrytype(st_ParallelUnion(geom, 2, 1)) from test'):
+    print row
+    break
+
+
+# text output precision
+print 'text output precision'
+for row in cur.execute('select st_AsText(geom, 2), st_AsGeoJSON(geom, 2) from test'):
+    print row
+    break
+
+
+# measures
+print 'measures'
+for row in cur.execute('select st_Area(geom), st_Length(geom), st_Perimeter(geom), st_AsText(st_Centroid(geom)) from test'):
+    print row
+    break
+
+
+# nearest neighbours
+print 'nearest neighbours'
+for row in cur.execute("select nn.key, t.rowid from json_each(st_KNN('test', 'geom', st_Point(0,0), 3)) as nn, test as t where t.rowid = nn.value order by nn.key"):
+    print row
+# empty geoms have no distance and are never returned
+for row in cur.execute("select json_array_length(st_KNN('test', 'geom', st_Point(0,0), 1000000)), count(st_Xmin(geom)) from test"):
+    print row
+
+
+# within distance
+print 'within distance'
+for row in cur.execute("select count(*) from test where st_DWithin(geom, st_Point(0,0), 10)"):
+    print row
+for row in cur.execute("select count(*) from json_each(st_DWithinRowids('test', 'geom', st_Point(0,0), 10))"):
+    print row
+
+
+# spatial join
+print 'spatial join'
+for row in cur.execute("select count(*) from json_each(st_SpatialJoin('test', 'geom', 'test', 'geom2', 'intersects'))"):
+    print row
+
+
+# clustering keys
+print 'clustering keys'
+for row in cur.execute('select st_HilbertKey(geom, st_MakeEnvelope(-180,-90,180,90)), st_ZOrderKey(geom, st_MakeEnvelope(-180,-90,180,90), 8) from test'):
+    print row
+    break
+postqlite.geometry.cluster_table(db, 'test', 'geom')
+
+
+# geohash and quadkey
+print 'geohash and quadkey'
+for row in cur.execute('select st_GeoHash(geom), st_GeoHash(geom, 5), st_QuadKey(geom, 10) from test'):
+    print row
+    break
+print postqlite.geometry.keys.geohash_ranges((10.7, 59.9, 10.8, 60.0))
+
+
+
+
+
+
+
+
+
+
+
+
 
 
 
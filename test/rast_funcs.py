@@ -358,6 +358,56 @@ rastclip = rast.clip(buff) # crop
 Image.fromarray(rastclip.data(1)).show()
 
 
+# rasterize all touched
+georast = buff.as_raster(rast, 'u1', 255, 0, True)
+Image.fromarray(georast.data(1)).show()
+
+# zonal stats
+cur.execute('create table zones (geom geom)')
+cur.execute('insert into zones values (st_Buffer(st_Point(2000,2000), 500))')
+cur.execute('insert into zones values (st_Buffer(st_Point(3000,1500), 200))')
+for row in cur.execute('''select z.key, z.value
+                        from json_each(rt_ZonalStats('zones', 'geom', 'test', 'rast', 1, 'count,mean,stddev,min,max')) as z'''):
+    print row
+print postqlite.raster.zonal_stats(db, 'zones', 'geom', 'test', 'rast', 2, ['mean','histogram'])
+
+# summary stats over all tiles
+print 'summarystats', cur.execute('select rt_SummaryStats(rast) from test limit 1').fetchone()
+print 'summarystatsagg', cur.execute('select rt_SummaryStatsAgg(rast, 1, 1) from test').fetchone()
+
+# map algebra expressions
+expr = postqlite.raster.expression.compile_expression('case when [rast] > 10 and not [rast] between 100 and 200 then sqrt([rast]) * 2 else null end')
+print expr, expr.names
+for row in cur.execute('''select rt_SummaryStats(rt_MapAlgebra(rast, 1, 'f4', 'case [rast] when 0 then 1 when 255 then 2 else max([rast] % 7, 3) end', 0)) from test limit 1'''):
+    print row
+
+# rasterized geometry band access
+for (georast,) in cur.execute('''select st_AsRaster(st_Buffer(st_Point(2000,2000), 500), rast, 'u1', 255, 0) as "[rast]" from test limit 1'''):
+    print georast.metadata()['numbands'], georast.data(1).count()
+    print georast.summarystats()
+
+# large expressions (numexpr or row blocks) should match the direct numpy plan
+import numpy as np
+expression = postqlite.raster.expression
+env = {'rast1': np.arange(-40000, 50000, dtype='i4').reshape((300,300)) % 5,
+       'rast2': np.arange(90000, dtype='f8').reshape((300,300)) % 3}
+for text in ['not [rast1]', '[rast1] > 0 and [rast2]', 'case when [rast1] then [rast2] else 2 end']:
+    expr = expression.compile_expression(text)
+    direct = expr.evaluate(env, 0)
+    for use_numexpr in (True, False):
+        expression.USE_NUMEXPR = use_numexpr
+        out = np.empty((300,300), 'f8')
+        expr.evaluate(env, 0, out=out)
+        print text, use_numexpr, (out == direct).all()
+expression.USE_NUMEXPR = True
+
+
+
+
+
+
+
+
 
 
 